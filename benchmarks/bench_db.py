@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database, AsyncDatabase
+
+
+class SyncAdapter:
+    # Старое поведение: sqlite вызывается прямо из корутины хендлера, каждая запись — отдельный коммит
+    def __init__(self, database):
+        self.database = database
+
+    async def update_interaction(self, user_id):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.database.cursor.execute("UPDATE users SET last_interaction = ? WHERE user_id = ?", (now, user_id))
+        self.database.conn.commit()
+
+    async def log_event(self, user_id, event_type, content):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.database.cursor.execute("""
+            INSERT INTO logs (user_id, event_type, content, timestamp)
+            VALUES (?, ?, ?, ?)
+        """, (user_id, event_type, content, now))
+        self.database.conn.commit()
+
+    async def close(self):
+        self.database.close()
+
+
+async def watch_loop_lag(stop, result):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        result.append(time.perf_counter() - started - 0.001)
+
+
+async def run(store, users, updates_per_user, network_delay):
+    async def handler(user_id):
+        for _ in range(updates_per_user):
+            await store.update_interaction(user_id)
+            await store.log_event(user_id, "Действие", "bench")
+            await asyncio.sleep(network_delay)
+
+    stop = asyncio.Event()
+    lags = []
+    watcher = asyncio.create_task(watch_loop_lag(stop, lags))
+    started = time.perf_counter()
+    await asyncio.gather(*(handler(user_id) for user_id in range(users)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await watcher
+    await store.close()
+    return users * updates_per_user / elapsed, max(lags, default=0.0)
+
+
+def make_database(path, synchronous):
+    database = Database(path)
+    database.conn.execute(f"PRAGMA synchronous={synchronous}")
+    for user_id in range(1000):
+        database.add_or_update_user(user_id, f"user{user_id}", "Bench")
+    return database
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест слоя БД: updates/sec и задержка event loop")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--updates", type=int, default=10)
+    parser.add_argument("--network-delay", type=float, default=0.05)
+    parser.add_argument("--synchronous", default="FULL")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, wrap in (("sync sqlite3", SyncAdapter), ("AsyncDatabase", AsyncDatabase)):
+            store = wrap(make_database(os.path.join(tmp, f"{name.replace(' ', '_')}.db"), args.synchronous))
+            rate, lag = asyncio.run(run(store, args.users, args.updates, args.network_delay))
+            print(f"{name:>14}: {rate:8.1f} updates/sec, max event loop lag {lag * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
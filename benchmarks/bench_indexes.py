@@ -0,0 +1,96 @@
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from migrations import apply_migrations
+
+QUERIES = {
+    "get_user_logs": (
+        "SELECT event_type, content, timestamp FROM logs WHERE user_id = ? ORDER BY timestamp ASC",
+        lambda users, limit_time: (random.randrange(users),),
+    ),
+    "get_users_for_reminder": (
+        "SELECT user_id FROM users WHERE is_finished = 0 AND reminded = 0 AND last_interaction < ?",
+        lambda users, limit_time: (limit_time,),
+    ),
+    "get_all_users_paginated": (
+        "SELECT user_id, first_name, username, joined_at FROM users ORDER BY joined_at DESC LIMIT 10 OFFSET ?",
+        lambda users, limit_time: (random.randrange(100) * 10,),
+    ),
+}
+
+
+def fill(conn, users, rows):
+    start = datetime.datetime.now() - datetime.timedelta(days=60)
+    fmt = "%Y-%m-%d %H:%M:%S"
+    conn.executemany(
+        "INSERT INTO users (user_id, username, first_name, joined_at, last_interaction, is_finished, reminded) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            (
+                user_id, f"user{user_id}", "Bench",
+                (start + datetime.timedelta(seconds=user_id * 60)).strftime(fmt),
+                (start + datetime.timedelta(seconds=user_id * 90)).strftime(fmt),
+                int(user_id % 3 == 0), int(user_id % 5 == 0),
+            )
+            for user_id in range(users)
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO logs (user_id, event_type, content, timestamp) VALUES (?, ?, ?, ?)",
+        (
+            (
+                random.randrange(users), "Действие", "Нажал кнопку 'Пройти опрос'",
+                (start + datetime.timedelta(seconds=i * 5)).strftime(fmt),
+            )
+            for i in range(rows)
+        ),
+    )
+    conn.commit()
+
+
+def measure(conn, users, repeat):
+    limit_time = (datetime.datetime.now() - datetime.timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+    result = {}
+    for name, (sql, make_args) in QUERIES.items():
+        plan = " / ".join(row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, make_args(users, limit_time)))
+        started = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(sql, make_args(users, limit_time)).fetchall()
+        result[name] = ((time.perf_counter() - started) / repeat, plan)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Запросы к users/logs до и после миграций с индексами")
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "bench.db"))
+        apply_migrations(conn, target=1)
+        fill(conn, args.users, args.rows)
+
+        before = measure(conn, args.users, args.repeat)
+        started = time.perf_counter()
+        version = apply_migrations(conn)
+        print(f"migrations up to v{version}: {time.perf_counter() - started:.2f} s")
+        after = measure(conn, args.users, args.repeat)
+        conn.close()
+
+    for name in QUERIES:
+        print(f"{name}: {before[name][0] * 1000:8.2f} ms -> {after[name][0] * 1000:8.2f} ms")
+        print(f"    before: {before[name][1]}")
+        print(f"    after:  {after[name][1]}")
+
+
+if __name__ == "__main__":
+    main()
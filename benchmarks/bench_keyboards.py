@@ -0,0 +1,58 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from funnel import ANSWERS, Q3_BY_Q2, Q3_QUESTION
+
+
+def build_per_callback(choice):
+    # Так process_q2 собирал ответ до появления funnel.py: словари, текст и разметка на каждый callback
+    text_map = {key: intro for key, (_, intro) in ANSWERS["q2"].items()}
+    full_text = f"{text_map.get(choice, '')}\n\n{Q3_QUESTION}"
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Хочу начать уже сейчас", callback_data="q3_now")],
+        [InlineKeyboardButton(text="Думаю, но пока откладываю", callback_data="q3_think")],
+        [InlineKeyboardButton(text="Интересно, но нет уверенности", callback_data="q3_unsure")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_q2")]
+    ])
+    return full_text, kb
+
+
+def use_compiled(choice):
+    step = Q3_BY_Q2.get(choice, Q3_BY_Q2[None])
+    return step.text, step.markup
+
+
+def measure(func, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func("q2_friends")
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    keep = [func("q2_friends") for _ in range(1000)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename")) / len(keep)
+    return elapsed / iterations, allocated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время и память на сборку ответа одного callback")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    for name, func in (("per callback", build_per_callback), ("compiled", use_compiled)):
+        per_call, allocated = measure(func, args.iterations)
+        print(f"{name:>12}: {per_call * 1e6:8.2f} us/callback, {allocated:8.0f} bytes retained/callback")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import time
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+
+class FakeBotAPI:
+    # Минимальный Bot API: отвечает ok на любые методы, для send*/edit* возвращает правдоподобный Message.
+    # Бот направляется сюда через TELEGRAM_API_URL, запросы считаются по методам.
+    def __init__(self, latency=0.0, member_status="member"):
+        self.latency = latency
+        self.member_status = member_status
+        self.calls = collections.Counter()
+        self.message_ids = itertools.count(1000)
+
+    def _message(self, params):
+        chat_id = int(params.get("chat_id") or 0)
+        message = {
+            "message_id": next(self.message_ids), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if "video" in params:
+            message["video"] = {"file_id": "fake_video", "file_unique_id": "fake", "width": 1, "height": 1, "duration": 1}
+        return message
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getChatMember":
+            return {"status": self.member_status, "user": {"id": int(params.get("user_id") or 0), "is_bot": False, "first_name": "Load"}}
+        if method == "getUpdates":
+            return []
+        if method == "getFile":
+            return {"file_id": params.get("file_id"), "file_unique_id": "fake", "file_size": 1, "file_path": "videos/fake.mp4"}
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media") or "[]")
+            return [self._message({"chat_id": params.get("chat_id"), "video": item.get("media")}) for item in media]
+        if method.startswith("send") or method.startswith("edit"):
+            return self._message(params)
+        return True
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная заглушка Telegram Bot API для нагрузочных прогонов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Искусственная задержка ответа")
+    args = parser.parse_args()
+    api = FakeBotAPI(latency=args.latency_ms / 1000)
+    web.run_app(api.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
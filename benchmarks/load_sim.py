@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_bot_api import FakeBotAPI
+from replay_updates import FUNNEL, make_update
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def configure_env(workdir, api_url):
+    # Всё, что читает config.py, задаётся до импорта main; база и архив создаются во временном каталоге
+    os.environ.update({
+        "BOT_TOKEN": "123456:FAKE-load-simulator",
+        "CHANNEL_ID": "-1001",
+        "TELEGRAM_API_URL": api_url,
+        "VIDEO_WELCOME_ID": "fake_video",
+        "VIDEO_LESSON_1_ID": "fake_video",
+        "VIDEO_LESSON_2_ID": "fake_video",
+        "VIDEO_LESSON_3_ID": "fake_video",
+        "WEBHOOK_ENABLED": "0",
+        "METRICS_PORT": "0",
+        "LOG_RETENTION_DAYS": "0",
+        "LOG_ARCHIVE_DIR": os.path.join(workdir, "log_archive"),
+        "MEDIA_DIR": os.path.join(workdir, "media"),
+    })
+    os.chdir(workdir)
+
+
+async def wait_idle(app, timeout):
+    # Отложенные сообщения дней интенсива досылаются после ответа хендлера, их тоже дожидаемся
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not len(app.delivery) and not sum(app.outbound.queue_depth()):
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+async def simulate(args):
+    api = FakeBotAPI(latency=args.latency_ms / 1000)
+    runner, api_url = await api.start()
+    workdir = tempfile.mkdtemp(prefix="load_sim_")
+    configure_env(workdir, api_url)
+
+    import main as app
+    from aiogram import types
+    from sender import TokenBucket
+
+    if args.no_rate_limit:
+        app.outbound.global_bucket = TokenBucket(10 ** 6, 10 ** 6)
+        app.outbound.chat_rate = app.outbound.chat_burst = 10 ** 6
+
+    # Транзакции считаются по COMMIT в трейсе; строки — по total_changes, туда входят и роллапы из триггеров
+    conn = app.db.database.conn
+    commits = 0
+
+    def trace(sql):
+        nonlocal commits
+        if sql == "COMMIT":
+            commits += 1
+
+    await app.media.warmup()
+    delivery_task = asyncio.create_task(app.delivery.run())
+    api.calls.clear()
+    conn.set_trace_callback(trace)
+    changes_before = conn.total_changes
+
+    latencies = []
+    per_step = collections.defaultdict(list)
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def play(user_id):
+        nonlocal errors
+        async with semaphore:
+            for step in FUNNEL:
+                update = types.Update.model_validate(make_update(user_id, step), context={"bot": app.bot})
+                started = time.perf_counter()
+                try:
+                    await app.dp.feed_update(app.bot, update)
+                except Exception:
+                    errors += 1
+                elapsed = time.perf_counter() - started
+                latencies.append(elapsed)
+                per_step[step].append(elapsed)
+
+    if args.memory:
+        tracemalloc.start()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    await asyncio.gather(*(play(user_id) for user_id in range(args.first_user_id, args.first_user_id + args.users)))
+    elapsed = time.perf_counter() - started
+    idle = await wait_idle(app, args.drain_timeout)
+    drained = time.perf_counter() - started
+    await app.db.flush()
+    await app.storage.flush()
+    rows_changed = conn.total_changes - changes_before
+    traced = tracemalloc.get_traced_memory()[0] if args.memory else None
+    if args.memory:
+        tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    delivery_task.cancel()
+    await asyncio.gather(delivery_task, return_exceptions=True)
+    await app.delivery.stop()
+    await app.storage.close()
+    await app.db.close()
+    await app.bot.session.close()
+    await runner.cleanup()
+
+    latencies.sort()
+    result = {
+        "users": args.users,
+        "updates": len(latencies),
+        "errors": errors,
+        "elapsed_sec": round(elapsed, 3),
+        "drained_sec": round(drained, 3),
+        "drained": idle,
+        "updates_per_sec": round(len(latencies) / elapsed, 1),
+        "latency_ms": {name: round(percentile(latencies, q) * 1000, 2) for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+        "step_p95_ms": {step: round(percentile(sorted(values), 0.95) * 1000, 2) for step, values in per_step.items()},
+        "db_commits_per_user": round(commits / args.users, 2),
+        "db_rows_per_user": round(rows_changed / args.users, 1),
+        "api_calls": dict(api.calls),
+        "rss_kb_per_user": round((rss_after - rss_before) / args.users, 2),
+    }
+    if traced is not None:
+        result["traced_bytes_per_user"] = round(traced / args.users)
+    return result
+
+
+def print_report(result, baseline=None):
+    def delta(value, old):
+        if not old:
+            return ""
+        return f" ({(value - old) / old * 100:+.1f}%)"
+
+    old = baseline or {}
+    old_latency = old.get("latency_ms", {})
+    print(f"users: {result['users']}, updates: {result['updates']}, errors: {result['errors']}")
+    print(f"throughput: {result['updates_per_sec']} updates/sec{delta(result['updates_per_sec'], old.get('updates_per_sec'))}, "
+          f"all messages delivered in {result['drained_sec']} s" + ("" if result["drained"] else " (не дождались очереди)"))
+    print("latency " + ", ".join(
+        f"{name} {value} ms{delta(value, old_latency.get(name))}" for name, value in result["latency_ms"].items()
+    ))
+    print("step p95: " + ", ".join(f"{step} {value} ms" for step, value in result["step_p95_ms"].items()))
+    print(f"db per user: {result['db_commits_per_user']} commits{delta(result['db_commits_per_user'], old.get('db_commits_per_user'))}, "
+          f"{result['db_rows_per_user']} rows written{delta(result['db_rows_per_user'], old.get('db_rows_per_user'))}")
+    print(f"api calls: {result['api_calls']}")
+    memory = f"memory: {result['rss_kb_per_user']} KB RSS per user"
+    if "traced_bytes_per_user" in result:
+        memory += f", {result['traced_bytes_per_user']} B traced per user{delta(result['traced_bytes_per_user'], old.get('traced_bytes_per_user'))}"
+    print(memory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон воронки main.py против заглушки Bot API, без сети")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=100, help="Сколько пользователей проходят воронку одновременно")
+    parser.add_argument("--first-user-id", type=int, default=10 ** 9)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Задержка ответа заглушки Bot API")
+    parser.add_argument("--no-rate-limit", action="store_true", help="Снять лимиты OutboundQueue (30 msg/s и 1 msg/s на чат)")
+    parser.add_argument("--memory", action="store_true", help="Считать память через tracemalloc (медленнее)")
+    parser.add_argument("--drain-timeout", type=float, default=300.0)
+    parser.add_argument("--json", help="Сохранить результат для последующего сравнения")
+    parser.add_argument("--compare", help="JSON прошлого прогона: показать изменения в процентах")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    args.json = os.path.abspath(args.json) if args.json else None
+
+    result = asyncio.run(simulate(args))
+    print_report(result, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import itertools
+import json
+import statistics
+import time
+
+import aiohttp
+
+FUNNEL = [
+    "/start", "start_flow", "q1_food", "q2_inside", "q3_now", "start_intensive",
+    "day1_done", "day2_done", "intensive_complete", "sales_group", "topic_money", "final_yes",
+]
+
+update_ids = itertools.count(1)
+
+
+def make_update(user_id, step):
+    user = {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"load{user_id}"}
+    chat = {"id": user_id, "type": "private"}
+    now = int(time.time())
+    update_id = next(update_ids)
+    if step.startswith("/"):
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id, "date": now, "chat": chat, "from": user, "text": step,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(step)}],
+            },
+        }
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": str(user_id), "data": step,
+            "message": {"message_id": 1, "date": now, "chat": chat, "text": "..."},
+        },
+    }
+
+
+def funnel_updates(users, first_user_id):
+    # Апдейты одного пользователя идут строго по порядку, разные пользователи — параллельно
+    return [[make_update(user_id, step) for step in FUNNEL] for user_id in range(first_user_id, first_user_id + users)]
+
+
+def load_updates(path):
+    per_user = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            update = json.loads(line)
+            event = update.get("message") or update.get("callback_query") or {}
+            per_user.setdefault(event.get("from", {}).get("id"), []).append(update)
+    return list(per_user.values())
+
+
+async def replay(url, secret, streams, concurrency):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def play(session, updates):
+        nonlocal errors
+        async with semaphore:
+            for update in updates:
+                started = time.perf_counter()
+                async with session.post(url, json=update, headers=headers) as response:
+                    if response.status != 200:
+                        errors += 1
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(play(session, updates) for updates in streams))
+    elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Прогон апдейтов через локальный webhook без обращения к Telegram")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret")
+    parser.add_argument("--file", help="JSONL с апдейтами; по умолчанию генерируется полный проход воронки")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--first-user-id", type=int, default=10 ** 9)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    streams = load_updates(args.file) if args.file else funnel_updates(args.users, args.first_user_id)
+    latencies, errors, elapsed = asyncio.run(replay(args.url, args.secret, streams, args.concurrency))
+    latencies.sort()
+    print(f"updates: {len(latencies)}, errors: {errors}, {len(latencies) / elapsed:.1f} updates/sec")
+    if latencies:
+        print(
+            f"latency p50 {statistics.median(latencies) * 1000:.1f} ms, "
+            f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} ms, "
+            f"max {latencies[-1] * 1000:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import asyncio
+import time
+from contextlib import suppress
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from sender import PRIORITY_BULK
+
+
+class BroadcastEngine:
+    # Массовая рассылка по users: получатели читаются пачками по user_id, результаты пишутся в БД пачками,
+    # поэтому после рестарта рассылка продолжается с курсора и не шлёт повторно уже доставленное
+    def __init__(self, bot, db, outbound, chunk_size=500, record_every=50, progress_interval=3.0):
+        self.bot = bot
+        self.db = db
+        self.outbound = outbound
+        self.chunk_size = chunk_size
+        self.record_every = record_every
+        self.progress_interval = progress_interval
+        self.tasks = {}
+        self.cancelled = set()
+
+    async def start(self, admin_id, text, progress_message):
+        broadcast_id = await self.db.create_broadcast(admin_id, text, progress_message.chat.id, progress_message.message_id)
+        self._spawn(broadcast_id)
+        return broadcast_id
+
+    async def resume(self):
+        for broadcast_id in await self.db.get_running_broadcasts():
+            self._spawn(broadcast_id)
+
+    def cancel(self, broadcast_id):
+        if broadcast_id not in self.tasks:
+            return False
+        self.cancelled.add(broadcast_id)
+        return True
+
+    async def stop(self):
+        # При остановке процесса рассылки прерываются, уже полученные результаты успевают записаться в _run
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, broadcast_id):
+        if broadcast_id not in self.tasks:
+            self.tasks[broadcast_id] = asyncio.create_task(self._run(broadcast_id))
+
+    async def _deliver(self, user_id, text):
+        try:
+            await self.outbound.send(self.bot.send_message, priority=PRIORITY_BULK, chat_id=user_id, text=text)
+            return user_id, "sent"
+        except TelegramForbiddenError:
+            return user_id, "blocked"
+        except TelegramBadRequest as e:
+            return user_id, "blocked" if "chat not found" in str(e).lower() else "failed"
+        except Exception:
+            return user_id, "failed"
+
+    async def _run(self, broadcast_id):
+        results = []
+        deliveries = []
+        consumed = set()
+        text = None
+        try:
+            _, text, _, cursor, *_ = await self.db.get_broadcast(broadcast_id)
+            started = time.monotonic()
+            processed = 0
+            last_progress = 0.0
+            while broadcast_id not in self.cancelled:
+                recipients = await self.db.get_broadcast_recipients(broadcast_id, cursor, self.chunk_size)
+                if not recipients:
+                    break
+                deliveries = [asyncio.create_task(self._deliver(user_id, text)) for user_id in recipients]
+                consumed = set()
+                for future in asyncio.as_completed(deliveries):
+                    result = await future
+                    results.append(result)
+                    consumed.add(result[0])
+                    processed += 1
+                    if len(results) >= self.record_every:
+                        await self.db.record_broadcast_results(broadcast_id, results)
+                        results = []
+                    if time.monotonic() - last_progress >= self.progress_interval:
+                        last_progress = time.monotonic()
+                        await self._report(broadcast_id, processed / (last_progress - started))
+                cursor = recipients[-1]
+                await self.db.record_broadcast_results(broadcast_id, results, cursor)
+                results = []
+
+            status = "cancelled" if broadcast_id in self.cancelled else "done"
+            await self.db.finish_broadcast(broadcast_id, status)
+            await self._report(broadcast_id, processed / max(time.monotonic() - started, 1e-6))
+        except asyncio.CancelledError:
+            # Остановка процесса: ещё не отправленное снимаем с очереди, уже ушедшие в API запросы дожидаемся
+            # и всё доставленное, но не записанное, фиксируем — после рестарта эти получатели не получат сообщение повторно
+            if deliveries:
+                self.outbound.drop(PRIORITY_BULK, lambda kwargs: kwargs.get("text") == text)
+            for result in await asyncio.gather(*deliveries, return_exceptions=True):
+                if isinstance(result, tuple) and result[0] not in consumed:
+                    results.append(result)
+            if results:
+                await self.db.record_broadcast_results(broadcast_id, results)
+            raise
+        finally:
+            self.tasks.pop(broadcast_id, None)
+            self.cancelled.discard(broadcast_id)
+
+    async def _report(self, broadcast_id, rate):
+        _, _, status, _, total, sent, failed, blocked, chat_id, message_id = await self.db.get_broadcast(broadcast_id)
+        done = sent + failed + blocked
+        status_text = {"running": "идёт", "done": "завершена", "cancelled": "остановлена"}.get(status, status)
+        text = (
+            f"Рассылка #{broadcast_id}: {status_text}\n"
+            f"Обработано: {done}/{total}\n"
+            f"Доставлено: {sent}, ошибок: {failed}, заблокировали бота: {blocked}\n"
+            f"Скорость: {rate:.1f} сообщ./сек"
+        )
+        with suppress(TelegramBadRequest):
+            await self.bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id)
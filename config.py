@@ -10,4 +10,56 @@ ADMIN_IDS = [1015082973, 1931600027]
 VIDEO_WELCOME_ID = os.getenv('VIDEO_WELCOME_ID')
 VIDEO_LESSON_1_ID = os.getenv('VIDEO_LESSON_1_ID')
 VIDEO_LESSON_2_ID = os.getenv('VIDEO_LESSON_2_ID')
-VIDEO_LESSON_3_ID = os.getenv('VIDEO_LESSON_3_ID')
\ No newline at end of file
+VIDEO_LESSON_3_ID = os.getenv('VIDEO_LESSON_3_ID')
+
+LOG_BATCH_SIZE = int(os.getenv('LOG_BATCH_SIZE', 100))
+LOG_FLUSH_INTERVAL_MS = int(os.getenv('LOG_FLUSH_INTERVAL_MS', 200))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', 10000))
+FSM_FLUSH_INTERVAL_MS = int(os.getenv('FSM_FLUSH_INTERVAL_MS', 100))
+
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+WEBHOOK_ENABLED = os.getenv('WEBHOOK_ENABLED', '0') == '1'
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 32))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+
+REPORT_GZIP_THRESHOLD = int(os.getenv('REPORT_GZIP_THRESHOLD', 5000))
+REPORT_DEDUP_WINDOW = int(os.getenv('REPORT_DEDUP_WINDOW', 86400))
+# Дайджест отчётов админам: раз в REPORT_DIGEST_INTERVAL секунд или по REPORT_DIGEST_SIZE отчётов; 0 — каждый отчёт сразу
+REPORT_DIGEST_INTERVAL = int(os.getenv('REPORT_DIGEST_INTERVAL', 3600))
+REPORT_DIGEST_SIZE = int(os.getenv('REPORT_DIGEST_SIZE', 500))
+# Финальные события, о которых в режиме дайджеста всё равно сообщаем сразу (через запятую)
+REPORT_IMMEDIATE_CODES = [code for code in os.getenv('REPORT_IMMEDIATE_CODES', 'final:yes').split(',') if code]
+
+SUBSCRIPTION_POSITIVE_TTL = int(os.getenv('SUBSCRIPTION_POSITIVE_TTL', 3600))
+SUBSCRIPTION_NEGATIVE_TTL = int(os.getenv('SUBSCRIPTION_NEGATIVE_TTL', 60))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', 10000))
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9101))
+
+LOG_RETENTION_DAYS = int(os.getenv('LOG_RETENTION_DAYS', 90))
+LOG_RETENTION_INTERVAL = int(os.getenv('LOG_RETENTION_INTERVAL', 3600))
+LOG_ARCHIVE_DIR = os.getenv('LOG_ARCHIVE_DIR', 'log_archive')
+
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 64))
+
+INTENSIVE_DRIP_HOURS = int(os.getenv('INTENSIVE_DRIP_HOURS', 0))
+
+MEDIA_DIR = os.getenv('MEDIA_DIR', 'media')
+MEDIA_UPLOAD_CHAT_ID = int(os.getenv('MEDIA_UPLOAD_CHAT_ID', ADMIN_IDS[0]))
+
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+
+WORKERS = int(os.getenv('WORKERS', 1))
+WORKER_BASE_PORT = int(os.getenv('WORKER_BASE_PORT', 8100))
+WORKER_INDEX = int(os.getenv('WORKER_INDEX', 0))
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', 1))
+WORKER_PORT = int(os.getenv('WORKER_PORT', 0))
@@ -1,100 +1,684 @@
+import asyncio
+import collections
 import sqlite3
 import datetime
+import functools
+import gzip
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL_MS, LOG_QUEUE_SIZE, LOG_ARCHIVE_DIR, USER_CACHE_SIZE
+from event_buffer import EventBuffer
+from metrics import DB_LATENCY
+from migrations import apply_migrations
+
+ARCHIVE_FIELDS = ("id", "user_id", "event_type", "content", "timestamp", "code")
+# Границы совпадения в сниппетах поиска; в HTML их заменяет вызывающий код
+MATCH_START, MATCH_END = "\x02", "\x03"
+
+
+def match_query(text):
+    # Каждое слово запроса — отдельная фраза с поиском по префиксу: синтаксис FTS5 из ввода не интерпретируется,
+    # а topic_money превращается во фразу "topic money", которая совпадает и с кодом topic:money
+    words = [word for word in text.replace('"', " ").split() if any(ch.isalnum() for ch in word)]
+    return " ".join(f'"{word}"*' for word in words)
+
 
 class Database:
-    def __init__(self, db_name="bot_database.db"):
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
-        self.create_tables()
+    # Файл открывается и миграции применяются не при импорте, а в open(): явно на старте
+    # или при первом обращении к conn/cursor
+    def __init__(self, db_name="bot_database.db", archive_dir=LOG_ARCHIVE_DIR):
+        self.db_name = db_name
+        self.archive_dir = archive_dir
+        self._conn = None
+        self._cursor = None
+
+    def open(self):
+        if self._conn is not None:
+            return
+        conn = sqlite3.connect(self.db_name, check_same_thread=False)
+        # Для новой базы действует сразу; существующую переводит enable_incremental_vacuum
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # С воркерами супервизора базу пишут несколько процессов: ждём освобождения блокировки, а не падаем
+        conn.execute("PRAGMA busy_timeout=5000")
+        apply_migrations(conn)
+        self._conn = conn
+        self._cursor = conn.cursor()
 
-    def create_tables(self):
+    @property
+    def conn(self):
+        if self._conn is None:
+            self.open()
+        return self._conn
+
+    @property
+    def cursor(self):
+        if self._cursor is None:
+            self.open()
+        return self._cursor
+
+    def get_user_row(self, user_id):
         self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                joined_at TEXT,
-                last_interaction TEXT,
-                is_finished BOOLEAN DEFAULT 0,
-                reminded BOOLEAN DEFAULT 0
-            )
-        """)
+            SELECT username, first_name, last_interaction, is_finished, is_blocked
+            FROM users WHERE user_id = ?
+        """, (user_id,))
+        return self.cursor.fetchone()
+
+    def upsert_user(self, user_id, username, first_name, now):
         self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                event_type TEXT,
-                content TEXT,
-                timestamp TEXT
-            )
-        """)
+            INSERT INTO users (user_id, username, first_name, joined_at, last_interaction)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name,
+                last_interaction = MAX(COALESCE(last_interaction, ''), excluded.last_interaction), is_blocked = 0
+        """, (user_id, username, first_name, now, now))
         self.conn.commit()
 
     def add_or_update_user(self, user_id, username, first_name):
+        # Запись только для нового пользователя, сменившихся имени/ника или снятой блокировки;
+        # last_interaction пишет буфер событий
         now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        if self.cursor.fetchone():
-            self.cursor.execute("""
-                UPDATE users SET last_interaction = ?, username = ?, first_name = ? 
-                WHERE user_id = ?
-            """, (now, username, first_name, user_id))
-        else:
-            self.cursor.execute("""
-                INSERT INTO users (user_id, username, first_name, joined_at, last_interaction)
-                VALUES (?, ?, ?, ?, ?)
-            """, (user_id, username, first_name, now, now))
-        self.conn.commit()
+        row = self.get_user_row(user_id)
+        if row is not None and row[:2] == (username, first_name) and not row[4]:
+            return False, row
+        self.upsert_user(user_id, username, first_name, now)
+        if row is None:
+            return True, (username, first_name, now, 0, 0)
+        return False, (username, first_name, now, row[3], 0)
 
-    def log_event(self, user_id, event_type, content):
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.cursor.execute("""
-            INSERT INTO logs (user_id, event_type, content, timestamp)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, event_type, content, now))
-        self.conn.commit()
+    def write_batch(self, log_rows, interaction_rows):
+        with self.conn:
+            if log_rows:
+                self.conn.executemany("""
+                    INSERT INTO logs (user_id, event_type, content, timestamp, code)
+                    VALUES (?, ?, ?, ?, ?)
+                """, log_rows)
+            if interaction_rows:
+                self.conn.executemany("""
+                    UPDATE users SET last_interaction = MAX(COALESCE(last_interaction, ''), ?), is_blocked = 0
+                    WHERE user_id = ?
+                """, interaction_rows)
 
     def mark_finished(self, user_id):
         self.cursor.execute("UPDATE users SET is_finished = 1 WHERE user_id = ?", (user_id,))
         self.conn.commit()
 
-    def get_users_for_reminder(self):
-        limit_time = (datetime.datetime.now() - datetime.timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
-        self.cursor.execute("""
-            SELECT user_id FROM users 
-            WHERE is_finished = 0 AND reminded = 0 AND last_interaction < ?
-        """, (limit_time,))
-        return [row[0] for row in self.cursor.fetchall()]
-
-    def set_reminded(self, user_id):
-        self.cursor.execute("UPDATE users SET reminded = 1 WHERE user_id = ?", (user_id,))
-        self.conn.commit()
+    def get_reminder_candidates(self, user_ids=None):
+        if user_ids is None:
+            self.cursor.execute("""
+                SELECT user_id, last_interaction FROM users
+                WHERE is_finished = 0 AND reminded = 0 AND is_blocked = 0
+            """)
+        else:
+            placeholders = ",".join("?" * len(user_ids))
+            self.cursor.execute(f"""
+                SELECT user_id, last_interaction FROM users
+                WHERE is_finished = 0 AND reminded = 0 AND is_blocked = 0 AND user_id IN ({placeholders})
+            """, list(user_ids))
+        return self.cursor.fetchall()
 
-    def update_interaction(self, user_id):
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.cursor.execute("UPDATE users SET last_interaction = ? WHERE user_id = ?", (now, user_id))
-        self.conn.commit()
+    def set_reminded_many(self, user_ids):
+        with self.conn:
+            self.conn.executemany("UPDATE users SET reminded = 1 WHERE user_id = ?", [(user_id,) for user_id in user_ids])
 
-    def get_all_users_paginated(self, page, limit=10):
-        offset = page * limit
+    def get_users_page(self, cursor=None, backward=False, limit=10):
+        # Keyset-пагинация по (joined_at, user_id): стоимость страницы не зависит от её номера
+        if cursor is None:
+            self.cursor.execute("""
+                SELECT user_id, first_name, username, joined_at
+                FROM users ORDER BY joined_at DESC, user_id DESC LIMIT ?
+            """, (limit,))
+            return self.cursor.fetchall()
+        if backward:
+            self.cursor.execute("""
+                SELECT user_id, first_name, username, joined_at
+                FROM users WHERE (joined_at, user_id) > (?, ?)
+                ORDER BY joined_at ASC, user_id ASC LIMIT ?
+            """, (*cursor, limit))
+            return self.cursor.fetchall()[::-1]
         self.cursor.execute("""
-            SELECT user_id, first_name, username, joined_at 
-            FROM users ORDER BY joined_at DESC LIMIT ? OFFSET ?
-        """, (limit, offset))
+            SELECT user_id, first_name, username, joined_at
+            FROM users WHERE (joined_at, user_id) < (?, ?)
+            ORDER BY joined_at DESC, user_id DESC LIMIT ?
+        """, (*cursor, limit))
         return self.cursor.fetchall()
 
     def get_user_count(self):
         self.cursor.execute("SELECT COUNT(*) FROM users")
         return self.cursor.fetchone()[0]
 
-    def get_user_logs(self, user_id):
-        self.cursor.execute("""
+    def search_users(self, text, limit=10, offset=0):
+        # Сначала найденные по нику/имени (по bm25), затем по логам — у кого больше совпавших строк.
+        # bm25 по строкам логов не считаем: на частых словах это сотни тысяч вызовов
+        # Возвращает (total, [(user_id, first_name, username, log_hits, snippet), ...])
+        query = match_query(text)
+        if not query:
+            return 0, []
+        rows = self.conn.execute("""
+            WITH hits AS (
+                SELECT rowid AS user_id, 0 AS kind, bm25(users_fts) AS score
+                FROM users_fts WHERE users_fts MATCH :query
+                UNION ALL
+                SELECT logs.user_id, 1, 0
+                FROM logs_fts JOIN logs ON logs.id = logs_fts.rowid WHERE logs_fts MATCH :query
+            )
+            SELECT hits.user_id, users.first_name, users.username, SUM(hits.kind), COUNT(*) OVER ()
+            FROM hits LEFT JOIN users ON users.user_id = hits.user_id
+            GROUP BY hits.user_id
+            ORDER BY MIN(hits.kind), MIN(hits.score), SUM(hits.kind) DESC, hits.user_id
+            LIMIT :limit OFFSET :offset
+        """, {"query": query, "limit": limit, "offset": offset}).fetchall()
+        if not rows:
+            return 0, []
+        # Сниппеты строим только для пользователей текущей страницы: лучшая по рангу строка лога каждого.
+        # Показываем текст события, даже если совпал только код: «Выбрал тему: Деньги» понятнее, чем topic:money
+        snippets = {}
+        user_ids = [row[0] for row in rows if row[3]]
+        if user_ids:
+            placeholders = ", ".join("?" * len(user_ids))
+            for user_id, snippet in self.conn.execute(f"""
+                SELECT logs.user_id, snippet(logs_fts, 0, ?, ?, '…', 12)
+                FROM logs_fts JOIN logs ON logs.id = logs_fts.rowid
+                WHERE logs_fts MATCH ? AND logs.user_id IN ({placeholders})
+                ORDER BY bm25(logs_fts)
+            """, (MATCH_START, MATCH_END, query, *user_ids)):
+                snippets.setdefault(user_id, snippet)
+        return rows[0][4], [row[:4] + (snippets.get(row[0]),) for row in rows]
+
+    def iter_user_logs(self, user_id, chunk_size=500, include_archive=False):
+        # Архив целиком старше горячих строк, поэтому порядок по времени сохраняется без общей сортировки
+        if include_archive:
+            yield from self.iter_archived_logs(user_id)
+        cursor = self.conn.cursor()
+        cursor.execute("""
             SELECT event_type, content, timestamp FROM logs 
             WHERE user_id = ? ORDER BY timestamp ASC
         """, (user_id,))
-        return self.cursor.fetchall()
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+
+    def export_user_logs(self, user_id, header, gzip_threshold, include_archive=False):
+        # Строки идут из курсора прямо в один буфер, без промежуточного списка и склейки строк
+        self.cursor.execute("SELECT COUNT(*) FROM logs WHERE user_id = ?", (user_id,))
+        count = self.cursor.fetchone()[0]
+        if include_archive:
+            self.cursor.execute("SELECT COALESCE(SUM(rows), 0) FROM log_archive_index WHERE user_id = ?", (user_id,))
+            count += self.cursor.fetchone()[0]
+        if not count:
+            return None, False
+        compressed = count > gzip_threshold
+        buffer = io.BytesIO()
+        stream = gzip.GzipFile(fileobj=buffer, mode="wb") if compressed else buffer
+        stream.write(header.encode("utf-8"))
+        for event, content, time in self.iter_user_logs(user_id, include_archive=include_archive):
+            stream.write(f"[{time}] {event}: {content}\n".encode("utf-8"))
+        if compressed:
+            stream.close()
+        return buffer.getvalue(), compressed
+
+    def archive_path(self, month):
+        return os.path.join(self.archive_dir, f"logs-{month}.jsonl.gz")
+
+    def archive_logs(self, cutoff, limit=5000):
+        # Строки старше cutoff дописываются в помесячные gzip JSONL, из logs удаляются только после fsync архива.
+        # Падение между записью и удалением даст повтор строк в архиве; при чтении они отсеиваются по id
+        rows = self.conn.execute("""
+            SELECT id, user_id, event_type, content, timestamp, code FROM logs
+            WHERE timestamp < ? ORDER BY id LIMIT ?
+        """, (cutoff, limit)).fetchall()
+        if not rows:
+            return 0
+        os.makedirs(self.archive_dir, exist_ok=True)
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(row[4][:7], []).append(row)
+        counts = {}
+        for month, month_rows in by_month.items():
+            with open(self.archive_path(month), "ab") as raw:
+                # Каждый проход дописывает отдельный gzip-член, gzip.open читает их подряд
+                with gzip.GzipFile(fileobj=raw, mode="wb") as stream:
+                    for row in month_rows:
+                        stream.write((json.dumps(dict(zip(ARCHIVE_FIELDS, row)), ensure_ascii=False) + "\n").encode("utf-8"))
+                        counts[(row[1], month)] = counts.get((row[1], month), 0) + 1
+                raw.flush()
+                os.fsync(raw.fileno())
+        with self.conn:
+            self.conn.executemany("""
+                INSERT INTO log_archive_index (user_id, month, rows) VALUES (?, ?, ?)
+                ON CONFLICT(user_id, month) DO UPDATE SET rows = rows + excluded.rows
+            """, [(user_id, month, count) for (user_id, month), count in counts.items()])
+            # Выборка шла по id, значит все подходящие строки до последнего id уже в архиве
+            self.conn.execute("DELETE FROM logs WHERE id <= ? AND timestamp < ?", (rows[-1][0], cutoff))
+        return len(rows)
+
+    def iter_archived_logs(self, user_id):
+        self.cursor.execute("SELECT month FROM log_archive_index WHERE user_id = ? ORDER BY month", (user_id,))
+        months = [row[0] for row in self.cursor.fetchall()]
+        marker = f'"user_id": {user_id},'
+        seen = set()
+        for month in months:
+            path = self.archive_path(month)
+            if not os.path.exists(path):
+                continue
+            rows = []
+            with gzip.open(path, "rt", encoding="utf-8") as stream:
+                try:
+                    for line in stream:
+                        if marker not in line:
+                            continue
+                        record = json.loads(line)
+                        if record["user_id"] != user_id or record["id"] in seen:
+                            continue
+                        seen.add(record["id"])
+                        rows.append((record["event_type"], record["content"], record["timestamp"]))
+                except EOFError:
+                    # Недописанный последний член после падения: его строки остались в logs
+                    pass
+            rows.sort(key=lambda row: row[2])
+            yield from rows
+
+    def is_incremental_vacuum(self):
+        return self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+    def enable_incremental_vacuum(self):
+        # Перевод существующей базы требует одного полного VACUUM, дальше место возвращается порциями.
+        # Полный VACUUM блокирует базу, поэтому это отдельный шаг обслуживания: python retention.py --vacuum
+        if self.is_incremental_vacuum():
+            return False
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute("VACUUM")
+        return True
+
+    def compact(self, pages=1000):
+        # Без auto_vacuum=INCREMENTAL incremental_vacuum ничего не делает: возвращаем 0, чтобы не крутиться в цикле
+        if not self.is_incremental_vacuum():
+            return 0
+        self.conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        return self.conn.execute("PRAGMA freelist_count").fetchone()[0]
 
     def get_user_info(self, user_id):
         self.cursor.execute("SELECT username, first_name FROM users WHERE user_id = ?", (user_id,))
         return self.cursor.fetchone()
 
-db = Database()
\ No newline at end of file
+    def get_funnel_totals(self):
+        self.cursor.execute("SELECT code, events, users FROM funnel_totals")
+        return self.cursor.fetchall()
+
+    def get_funnel_daily(self, day):
+        self.cursor.execute("SELECT code, events, users FROM funnel_daily WHERE day = ?", (day,))
+        return self.cursor.fetchall()
+
+    def get_user_summary(self, user_id):
+        self.cursor.execute("""
+            SELECT q1, q2, q3, day, topic, sales, final, started_at, intensive_done_at, finished_at, updated_at
+            FROM user_summary WHERE user_id = ?
+        """, (user_id,))
+        return self.cursor.fetchone()
+
+    def claim_report(self, user_id, code, window, pending=False):
+        # Отметка об отчёте ставится, только если такого же отчёта не было за окно; rowcount 0 — повтор.
+        # pending ставит отчёт в очередь дайджеста
+        now = datetime.datetime.now()
+        cutoff = (now - datetime.timedelta(seconds=window)).strftime("%Y-%m-%d %H:%M:%S")
+        self.cursor.execute("""
+            INSERT INTO user_reports (user_id, code, reported_at, pending) VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, code) DO UPDATE SET reported_at = excluded.reported_at, pending = excluded.pending
+            WHERE reported_at < ?
+        """, (user_id, code, now.strftime("%Y-%m-%d %H:%M:%S"), int(pending), cutoff))
+        self.conn.commit()
+        return self.cursor.rowcount > 0
+
+    def count_pending_reports(self):
+        self.cursor.execute("SELECT COUNT(*) FROM user_reports WHERE pending = 1")
+        return self.cursor.fetchone()[0]
+
+    def get_pending_reports(self, limit=5000):
+        # (user_id, code, reported_at, first_name, username, *снимок user_summary) в порядке поступления
+        self.cursor.execute("""
+            SELECT r.user_id, r.code, r.reported_at, u.first_name, u.username,
+                s.q1, s.q2, s.q3, COALESCE(s.day, 0), s.topic, s.sales, s.final,
+                s.started_at, s.intensive_done_at, s.finished_at, s.updated_at
+            FROM user_reports r
+            LEFT JOIN users u ON u.user_id = r.user_id
+            LEFT JOIN user_summary s ON s.user_id = r.user_id
+            WHERE r.pending = 1
+            ORDER BY r.reported_at LIMIT ?
+        """, (limit,))
+        return self.cursor.fetchall()
+
+    def clear_pending_reports(self, rows):
+        # reported_at в условии: отчёт, заново поставленный в очередь во время отправки, не теряется
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE user_reports SET pending = 0 WHERE user_id = ? AND code = ? AND reported_at = ?", rows
+            )
+
+    def get_fsm(self, key):
+        self.cursor.execute("SELECT state, data FROM fsm_storage WHERE key = ?", (key,))
+        return self.cursor.fetchone()
+
+    def save_fsm_many(self, rows):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.conn:
+            self.conn.executemany("""
+                INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+            """, [(key, state, data, now) for key, state, data in rows])
+
+    def add_scheduled_messages(self, rows):
+        ids = []
+        with self.conn:
+            for chat_id, due_at, method, payload in rows:
+                cursor = self.conn.execute(
+                    "INSERT INTO scheduled_messages (chat_id, due_at, method, payload) VALUES (?, ?, ?, ?)",
+                    (chat_id, due_at, method, payload),
+                )
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def get_scheduled_messages(self):
+        self.cursor.execute("SELECT id, chat_id, due_at, method, payload FROM scheduled_messages ORDER BY due_at, id")
+        return self.cursor.fetchall()
+
+    def delete_scheduled_messages(self, ids):
+        with self.conn:
+            self.conn.executemany("DELETE FROM scheduled_messages WHERE id = ?", [(message_id,) for message_id in ids])
+
+    def get_media_files(self):
+        self.cursor.execute("SELECT key, file_id FROM media_files")
+        return dict(self.cursor.fetchall())
+
+    def save_media_file(self, key, file_id):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.conn:
+            self.conn.execute("""
+                INSERT INTO media_files (key, file_id, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET file_id = excluded.file_id, updated_at = excluded.updated_at
+            """, (key, file_id, now))
+
+    def create_broadcast(self, admin_id, text, progress_chat_id, progress_message_id):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.conn:
+            total = self.conn.execute("SELECT COUNT(*) FROM users WHERE is_blocked = 0").fetchone()[0]
+            cursor = self.conn.execute("""
+                INSERT INTO broadcasts (admin_id, text, status, total, progress_chat_id, progress_message_id, created_at)
+                VALUES (?, ?, 'running', ?, ?, ?, ?)
+            """, (admin_id, text, total, progress_chat_id, progress_message_id, now))
+        return cursor.lastrowid
+
+    def get_broadcast(self, broadcast_id):
+        self.cursor.execute("""
+            SELECT id, text, status, cursor, total, sent, failed, blocked, progress_chat_id, progress_message_id
+            FROM broadcasts WHERE id = ?
+        """, (broadcast_id,))
+        return self.cursor.fetchone()
+
+    def get_running_broadcasts(self):
+        self.cursor.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def get_broadcast_recipients(self, broadcast_id, after_user_id, limit):
+        # Получатели идут по возрастанию user_id от сохранённого курсора; уже доставленные в этой рассылке пропускаются
+        self.cursor.execute("""
+            SELECT user_id FROM users u
+            WHERE u.user_id > ? AND u.is_blocked = 0
+              AND NOT EXISTS (
+                  SELECT 1 FROM broadcast_deliveries d
+                  WHERE d.broadcast_id = ? AND d.user_id = u.user_id
+              )
+            ORDER BY u.user_id LIMIT ?
+        """, (after_user_id, broadcast_id, limit))
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def record_broadcast_results(self, broadcast_id, results, cursor=None):
+        counts = {"sent": 0, "failed": 0, "blocked": 0}
+        for _, status in results:
+            counts[status] += 1
+        blocked = [(user_id,) for user_id, status in results if status == "blocked"]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, status) VALUES (?, ?, ?)",
+                [(broadcast_id, user_id, status) for user_id, status in results],
+            )
+            if blocked:
+                self.conn.executemany("UPDATE users SET is_blocked = 1 WHERE user_id = ?", blocked)
+            self.conn.execute("""
+                UPDATE broadcasts SET sent = sent + ?, failed = failed + ?, blocked = blocked + ?,
+                    cursor = COALESCE(?, cursor)
+                WHERE id = ?
+            """, (counts["sent"], counts["failed"], counts["blocked"], cursor, broadcast_id))
+
+    def finish_broadcast(self, broadcast_id, status):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.conn:
+            self.conn.execute(
+                "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status = 'running'",
+                (status, now, broadcast_id),
+            )
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            self._cursor = None
+
+
+class AsyncDatabase:
+    # Все обращения к sqlite идут через один поток-писатель, чтобы commit не блокировал event loop
+    def __init__(self, database, batch_size=LOG_BATCH_SIZE, flush_interval_ms=LOG_FLUSH_INTERVAL_MS, max_queue=LOG_QUEUE_SIZE, user_count_ttl=60, user_cache_size=USER_CACHE_SIZE):
+        self.database = database
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        self.events = EventBuffer(database, self._run, batch_size, flush_interval_ms, max_queue)
+        self.interaction_listeners = []
+        self.user_count = None
+        self.user_count_expires = 0.0
+        self.user_count_ttl = user_count_ttl
+        # LRU профилей: user_id -> [username, first_name, last_interaction, is_finished, is_blocked]
+        self.users = collections.OrderedDict()
+        self.user_cache_size = user_cache_size
+        self.user_hits = 0
+        self.user_misses = 0
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        with DB_LATENCY.time(func.__name__):
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    def _notify_interaction(self, user_id):
+        for listener in self.interaction_listeners:
+            listener(user_id)
+
+    def _cached_user(self, user_id):
+        entry = self.users.get(user_id)
+        if entry is None:
+            self.user_misses += 1
+            return None
+        self.user_hits += 1
+        self.users.move_to_end(user_id)
+        return entry
+
+    def _cache_user(self, user_id, row):
+        self.users[user_id] = list(row)
+        self.users.move_to_end(user_id)
+        while len(self.users) > self.user_cache_size:
+            self.users.popitem(last=False)
+
+    async def add_or_update_user(self, user_id, username, first_name):
+        self._notify_interaction(user_id)
+        entry = self._cached_user(user_id)
+        created = False
+        if entry is None:
+            created, row = await self._run(self.database.add_or_update_user, user_id, username, first_name)
+            self._cache_user(user_id, row)
+            if created and self.user_count is not None:
+                self.user_count += 1
+        elif entry[0] != username or entry[1] != first_name or entry[4]:
+            # Имя, ник и снятие блокировки пишутся сразу (write-through), остальное не трогаем
+            now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            await self._run(self.database.upsert_user, user_id, username, first_name, now)
+            entry[0], entry[1], entry[2], entry[4] = username, first_name, now, 0
+        if not created:
+            await self._touch(user_id)
+        return created
+
+    async def _touch(self, user_id):
+        # last_interaction копится в буфере событий и пишется пачкой (write-back); та же запись снимает is_blocked:
+        # раз пользователь прислал апдейт, бот у него не заблокирован
+        entry = self.users.get(user_id)
+        if entry is not None:
+            entry[2] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            entry[4] = 0
+        await self.events.update_interaction(user_id)
+
+    async def log_event(self, user_id, event_type, content, code=None):
+        await self.events.log_event(user_id, event_type, content, code)
+
+    async def flush(self):
+        await self.events.flush()
+
+    async def mark_finished(self, user_id):
+        entry = self.users.get(user_id)
+        if entry is not None and entry[3]:
+            return
+        await self._run(self.database.mark_finished, user_id)
+        if entry is not None:
+            entry[3] = 1
+
+    async def get_reminder_candidates(self, user_ids=None):
+        await self.events.flush()
+        return await self._run(self.database.get_reminder_candidates, user_ids)
+
+    async def set_reminded_many(self, user_ids):
+        return await self._run(self.database.set_reminded_many, user_ids)
+
+    async def update_interaction(self, user_id):
+        self._notify_interaction(user_id)
+        await self._touch(user_id)
+
+    async def get_users_page(self, cursor=None, backward=False, limit=10):
+        return await self._run(self.database.get_users_page, cursor, backward, limit)
+
+    async def get_user_count(self):
+        # COUNT(*) по users не пересчитывается на каждом листании: кэш с коротким TTL плюс инкремент на новых пользователях
+        now = time.monotonic()
+        if self.user_count is None or now >= self.user_count_expires:
+            self.user_count = await self._run(self.database.get_user_count)
+            self.user_count_expires = now + self.user_count_ttl
+        return self.user_count
+
+    async def search_users(self, text, limit=10, offset=0):
+        await self.events.flush()
+        return await self._run(self.database.search_users, text, limit, offset)
+
+    async def export_user_logs(self, user_id, header, gzip_threshold, include_archive=False):
+        await self.events.flush()
+        return await self._run(self.database.export_user_logs, user_id, header, gzip_threshold, include_archive)
+
+    async def archive_logs(self, cutoff, limit=5000):
+        await self.events.flush()
+        return await self._run(self.database.archive_logs, cutoff, limit)
+
+    async def is_incremental_vacuum(self):
+        return await self._run(self.database.is_incremental_vacuum)
+
+    async def enable_incremental_vacuum(self):
+        return await self._run(self.database.enable_incremental_vacuum)
+
+    async def compact(self, pages=1000):
+        return await self._run(self.database.compact, pages)
+
+    async def get_user_info(self, user_id):
+        entry = self._cached_user(user_id)
+        if entry is None:
+            row = await self._run(self.database.get_user_row, user_id)
+            if row is None:
+                return None
+            self._cache_user(user_id, row)
+            return row[:2]
+        return entry[0], entry[1]
+
+    async def get_funnel_totals(self):
+        await self.events.flush()
+        return await self._run(self.database.get_funnel_totals)
+
+    async def get_funnel_daily(self, day):
+        await self.events.flush()
+        return await self._run(self.database.get_funnel_daily, day)
+
+    async def get_user_summary(self, user_id):
+        # Снимок обновляет триггер при записи логов, поэтому сначала досылаем буфер событий
+        await self.events.flush()
+        return await self._run(self.database.get_user_summary, user_id)
+
+    async def claim_report(self, user_id, code, window, pending=False):
+        return await self._run(self.database.claim_report, user_id, code, window, pending)
+
+    async def count_pending_reports(self):
+        return await self._run(self.database.count_pending_reports)
+
+    async def get_pending_reports(self, limit=5000):
+        await self.events.flush()
+        return await self._run(self.database.get_pending_reports, limit)
+
+    async def clear_pending_reports(self, rows):
+        return await self._run(self.database.clear_pending_reports, rows)
+
+    async def get_fsm(self, key):
+        return await self._run(self.database.get_fsm, key)
+
+    async def save_fsm_many(self, rows):
+        return await self._run(self.database.save_fsm_many, rows)
+
+    async def add_scheduled_messages(self, rows):
+        return await self._run(self.database.add_scheduled_messages, rows)
+
+    async def get_scheduled_messages(self):
+        return await self._run(self.database.get_scheduled_messages)
+
+    async def delete_scheduled_messages(self, ids):
+        return await self._run(self.database.delete_scheduled_messages, ids)
+
+    async def get_media_files(self):
+        return await self._run(self.database.get_media_files)
+
+    async def save_media_file(self, key, file_id):
+        return await self._run(self.database.save_media_file, key, file_id)
+
+    async def create_broadcast(self, admin_id, text, progress_chat_id, progress_message_id):
+        return await self._run(self.database.create_broadcast, admin_id, text, progress_chat_id, progress_message_id)
+
+    async def get_broadcast(self, broadcast_id):
+        return await self._run(self.database.get_broadcast, broadcast_id)
+
+    async def get_running_broadcasts(self):
+        return await self._run(self.database.get_running_broadcasts)
+
+    async def get_broadcast_recipients(self, broadcast_id, after_user_id, limit):
+        return await self._run(self.database.get_broadcast_recipients, broadcast_id, after_user_id, limit)
+
+    async def record_broadcast_results(self, broadcast_id, results, cursor=None):
+        await self._run(self.database.record_broadcast_results, broadcast_id, results, cursor)
+        for user_id, status in results:
+            entry = self.users.get(user_id)
+            if entry is not None and status == "blocked":
+                entry[4] = 1
+
+    async def finish_broadcast(self, broadcast_id, status):
+        return await self._run(self.database.finish_broadcast, broadcast_id, status)
+
+    async def open(self):
+        await self._run(self.database.open)
+
+    async def close(self):
+        await self.events.close()
+        await self._run(self.database.close)
+        self.executor.shutdown(wait=True)
+
+
+db = AsyncDatabase(Database())
\ No newline at end of file
@@ -0,0 +1,153 @@
+import asyncio
+import collections
+import datetime
+import heapq
+import json
+import logging
+
+from funnel import STEPS
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+METHODS = ("send_message", "send_video", "send_media_group")
+
+
+class DeliveryQueue:
+    # Отложенные сообщения хранятся в scheduled_messages и в куче (due_at, id): хендлер только ставит их
+    # в очередь и сразу возвращается, а один цикл досылает их по сроку. После рестарта куча читается из БД.
+    def __init__(self, bot, db, outbound, media, owns=None):
+        self.bot = bot
+        self.owns = owns
+        self.db = db
+        self.outbound = outbound
+        self.media = media
+        self.heap = []
+        self.sending = 0
+        # Наступившие сообщения по чатам и задача досылки каждого чата
+        self.chats = {}
+        self.tasks = {}
+        # Доставленные id удаляются из таблицы пачкой, а не отдельной транзакцией на каждый чат
+        self.delivered = []
+        self.cleanup_task = None
+        self.wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self.heap) + self.sending
+
+    async def schedule(self, chat_id, items, start=None):
+        # items: (смещение в секундах, метод, параметры); в пределах чата порядок задаётся (due_at, id).
+        # Вместо text/reply_markup можно передать step — имя шага воронки, вместо видео — video_key
+        # или media (список ключей MediaRegistry); всё это раскрывается при отправке, с актуальными file_id
+        start = start or datetime.datetime.now()
+        rows = []
+        for offset, method, kwargs in items:
+            if method not in METHODS:
+                raise ValueError(f"Неподдерживаемый метод отложенной отправки: {method}")
+            due_at = (start + datetime.timedelta(seconds=offset)).strftime(TIME_FORMAT)
+            rows.append((chat_id, due_at, method, json.dumps(kwargs, ensure_ascii=False)))
+        ids = await self.db.add_scheduled_messages(rows)
+        for message_id, (chat_id, due_at, method, payload) in zip(ids, rows):
+            heapq.heappush(self.heap, (due_at, message_id, chat_id, method, payload))
+        self.wakeup.set()
+
+    async def load(self):
+        self.heap = [(due_at, message_id, chat_id, method, payload)
+                     for message_id, chat_id, due_at, method, payload in await self.db.get_scheduled_messages()
+                     if self.owns is None or self.owns(chat_id)]
+        heapq.heapify(self.heap)
+
+    async def _wait(self, timeout):
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        while True:
+            try:
+                await self.load()
+                break
+            except Exception:
+                logging.exception("Не удалось загрузить отложенные сообщения, повтор")
+                await asyncio.sleep(5)
+        while True:
+            try:
+                if not self.heap:
+                    await self._wait(None)
+                    continue
+
+                now = datetime.datetime.now()
+                timeout = (datetime.datetime.strptime(self.heap[0][0], TIME_FORMAT) - now).total_seconds()
+                if timeout > 0:
+                    await self._wait(timeout)
+                    continue
+
+                due = now.strftime(TIME_FORMAT)
+                while self.heap and self.heap[0][0] <= due:
+                    _, message_id, chat_id, method, payload = heapq.heappop(self.heap)
+                    self.sending += 1
+                    self._dispatch(chat_id, (message_id, method, payload))
+            except Exception:
+                logging.exception("Ошибка цикла отложенной отправки")
+                await asyncio.sleep(1)
+
+    async def stop(self):
+        # Досылка чатов прерывается; уже доставленное удаляется из таблицы сразу, недоставленное уйдёт после рестарта
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.cleanup_task is not None:
+            self.cleanup_task.cancel()
+        if self.delivered:
+            await self._cleanup(0)
+
+    def _dispatch(self, chat_id, message):
+        # Чаты досылаются независимо друг от друга: чат на паузе из-за RetryAfter не задерживает остальные.
+        # Внутри чата одна задача и очередь, поэтому порядок сообщений сохраняется
+        self.chats.setdefault(chat_id, collections.deque()).append(message)
+        if chat_id not in self.tasks:
+            self.tasks[chat_id] = asyncio.create_task(self._deliver_chat(chat_id))
+
+    async def _deliver_chat(self, chat_id):
+        ids = []
+        messages = self.chats[chat_id]
+        try:
+            while messages:
+                message_id, method, payload = messages.popleft()
+                try:
+                    await self.outbound.send(getattr(self.bot, method), chat_id=chat_id, **self._resolve(method, payload))
+                except Exception:
+                    logging.exception("Не удалось доставить отложенное сообщение %s в чат %s", message_id, chat_id)
+                self.sending -= 1
+                ids.append(message_id)
+        finally:
+            del self.chats[chat_id]
+            del self.tasks[chat_id]
+            self.delivered.extend(ids)
+            if self.cleanup_task is None:
+                self.cleanup_task = asyncio.create_task(self._cleanup())
+
+    async def _cleanup(self, delay=0.5):
+        await asyncio.sleep(delay)
+        ids, self.delivered = self.delivered, []
+        self.cleanup_task = None
+        try:
+            await self.db.delete_scheduled_messages(ids)
+        except Exception:
+            # Строки останутся в таблице и после рестарта уйдут повторно; доставка при этом не останавливается
+            logging.exception("Не удалось удалить доставленные отложенные сообщения (%s шт.)", len(ids))
+
+    def _resolve(self, method, payload):
+        kwargs = json.loads(payload)
+        step = kwargs.pop("step", None)
+        if step is not None:
+            kwargs["text"] = STEPS[step].text
+            if STEPS[step].markup is not None:
+                kwargs["reply_markup"] = STEPS[step].markup
+        video_key = kwargs.pop("video_key", None)
+        if video_key is not None:
+            kwargs.update(self.media.video(video_key))
+        if method == "send_media_group":
+            kwargs["media"] = self.media.group(kwargs["media"])
+        return kwargs
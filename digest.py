@@ -0,0 +1,85 @@
+import asyncio
+import collections
+import csv
+import io
+import logging
+import time
+
+from aiogram.types import BufferedInputFile
+
+from funnel import summary_fields, terminal_label
+from sender import PRIORITY_REPORT
+
+
+class ReportDigest:
+    # Отчёты о завершивших воронку копятся в user_reports (pending = 1) и уходят каждому админу одним CSV
+    # с текстовой сводкой в подписи: раз в interval секунд или раньше, если набралось size отчётов.
+    # Очередь лежит в базе и переживает рестарт; отправляет её один процесс
+    def __init__(self, bot, db, outbound, admin_ids, interval, size, max_rows=5000):
+        self.bot = bot
+        self.db = db
+        self.outbound = outbound
+        self.admin_ids = admin_ids
+        self.interval = interval
+        self.size = size
+        self.max_rows = max_rows
+        self.check_interval = min(30, interval)
+        self.last_sent = time.monotonic()
+        self.reported = 0
+
+    def render_csv(self, rows):
+        buffer = io.StringIO()
+        # Точка с запятой и BOM: так файл без настроек открывается в русском Excel
+        writer = csv.writer(buffer, delimiter=";")
+        fields = [summary_fields(row[5:]) for row in rows]
+        writer.writerow(["ID", "Имя", "Ник", "Событие", "Время"] + [title for title, _ in fields[0]])
+        for row, row_fields in zip(rows, fields):
+            user_id, code, reported_at, first_name, username = row[:5]
+            writer.writerow(
+                [user_id, first_name or "", f"@{username}" if username else "", terminal_label(code), reported_at]
+                + [value for _, value in row_fields]
+            )
+        return buffer.getvalue().encode("utf-8-sig")
+
+    def render_caption(self, rows):
+        events = collections.Counter(terminal_label(row[1]) for row in rows)
+        topics = collections.Counter(dict(summary_fields(row[5:]))["Тема"] for row in rows)
+        topics.pop("—", None)
+        lines = [
+            f"Дайджест {rows[0][2]} — {rows[-1][2]}",
+            f"Завершили воронку: {len({row[0] for row in rows})}",
+            ", ".join(f"{label} – {count}" for label, count in events.most_common()),
+        ]
+        if topics:
+            lines.append("Темы: " + ", ".join(f"{label} – {count}" for label, count in topics.most_common()))
+        return "\n".join(lines)[:1024]
+
+    async def flush(self):
+        self.last_sent = time.monotonic()
+        rows = await self.db.get_pending_reports(self.max_rows)
+        if not rows:
+            return 0
+        file = BufferedInputFile(self.render_csv(rows), filename=f"digest_{rows[-1][2][:10]}.csv")
+        caption = self.render_caption(rows)
+        results = await asyncio.gather(*(
+            self.outbound.send(self.bot.send_document, priority=PRIORITY_REPORT, chat_id=admin_id, document=file, caption=caption)
+            for admin_id in self.admin_ids
+        ), return_exceptions=True)
+        failed = [result for result in results if isinstance(result, Exception)]
+        if len(failed) == len(results):
+            # Никому не дошло: строки остаются в очереди до следующей попытки
+            logging.error("Дайджест не отправлен: %s", failed[0])
+            return 0
+        await self.db.clear_pending_reports([row[:3] for row in rows])
+        self.reported += len(rows)
+        logging.info("Дайджест: %s отчётов отправлено админам", len(rows))
+        return len(rows)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                if time.monotonic() - self.last_sent >= self.interval or await self.db.count_pending_reports() >= self.size:
+                    await self.flush()
+            except Exception:
+                logging.exception("Ошибка отправки дайджеста")
@@ -0,0 +1,91 @@
+import asyncio
+import datetime
+import logging
+
+
+class EventBuffer:
+    # Копит строки логов и обновления last_interaction и пишет их одной транзакцией
+    def __init__(self, database, run, batch_size=100, flush_interval_ms=200, max_queue=10000):
+        self.database = database
+        self.run = run
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.wakeup = asyncio.Event()
+        self.full = asyncio.Event()
+        self.task = None
+        # Пачка, которую не удалось записать: уходит в начало следующей попытки
+        self.pending = []
+        self.failures = 0
+
+    def _ensure_started(self):
+        # Воркер поднимается заново, если задача по какой-то причине завершилась
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._worker())
+
+    async def _put(self, item):
+        self._ensure_started()
+        # При переполненной очереди put ждёт, пока воркер не сбросит пачку — это и есть backpressure
+        await self.queue.put(item)
+        self.wakeup.set()
+        if self.queue.qsize() >= self.batch_size or self.queue.full():
+            self.full.set()
+
+    async def log_event(self, user_id, event_type, content, code=None):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        await self._put(("log", (user_id, event_type, content, now, code)))
+
+    async def update_interaction(self, user_id):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        await self._put(("interaction", (user_id, now)))
+
+    async def _worker(self):
+        delay = self.flush_interval
+        while True:
+            await self.wakeup.wait()
+            try:
+                await asyncio.wait_for(self.full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+                delay = self.flush_interval
+            except Exception:
+                # Например, database is locked при нескольких процессах: строки остались в pending,
+                # очередь продолжает разбираться, повтор с нарастающей паузой
+                self.failures += 1
+                logging.exception("Ошибка записи пачки событий, повтор через %.1f с", delay)
+                self.wakeup.set()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+
+    async def flush(self):
+        self.wakeup.clear()
+        self.full.clear()
+        batch, self.pending = self.pending, []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if not batch:
+            return
+
+        log_rows = []
+        interactions = {}
+        for kind, row in batch:
+            if kind == "log":
+                log_rows.append(row)
+            else:
+                user_id, now = row
+                interactions[user_id] = now
+        interaction_rows = [(now, user_id) for user_id, now in interactions.items()]
+
+        try:
+            await self.run(self.database.write_batch, log_rows, interaction_rows)
+        except BaseException:
+            self.pending = batch + self.pending
+            raise
+
+    async def close(self):
+        await self.flush()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
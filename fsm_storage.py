@@ -0,0 +1,93 @@
+import asyncio
+import collections
+import copy
+import json
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+
+class SQLiteStorage(BaseStorage):
+    # FSM в том же bot_database.db: состояние переживает рестарт и видно другим процессам.
+    # Чтения обслуживает LRU-кэш, записи копятся в dirty и сбрасываются одной транзакцией раз в flush_interval.
+    def __init__(self, db, cache_size=10000, flush_interval_ms=100):
+        self.db = db
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.cache = collections.OrderedDict()
+        self.dirty = {}
+        self.task = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(key):
+        business_connection_id = getattr(key, "business_connection_id", None) or ""
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{business_connection_id}:{key.destiny}"
+
+    async def _load(self, key):
+        name = self._key(key)
+        record = self.cache.get(name)
+        if record is not None:
+            self.hits += 1
+            self.cache.move_to_end(name)
+            return name, record
+        self.misses += 1
+
+        record = self.dirty.get(name)
+        if record is None:
+            row = await self.db.get_fsm(name)
+            record = [row[0], json.loads(row[1]) if row and row[1] else {}] if row else [None, {}]
+            record = self.cache.get(name, record)
+        self.cache[name] = record
+        self._evict()
+        return name, record
+
+    def _evict(self):
+        # Грязные записи остаются в self.dirty до сброса, поэтому из кэша их можно вытеснять
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _mark_dirty(self, name, record):
+        self.dirty[name] = record
+        if self.task is None:
+            self.task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self.task = None
+        await self.flush()
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, {}
+        rows = [
+            (name, state, json.dumps(data, ensure_ascii=False))
+            for name, (state, data) in dirty.items()
+        ]
+        await self.db.save_fsm_many(rows)
+
+    async def set_state(self, key, state=None):
+        name, record = await self._load(key)
+        record[0] = state.state if isinstance(state, State) else state
+        self._mark_dirty(name, record)
+
+    async def get_state(self, key):
+        _, record = await self._load(key)
+        return record[0]
+
+    async def set_data(self, key, data):
+        name, record = await self._load(key)
+        record[1] = copy.copy(dict(data))
+        self._mark_dirty(name, record)
+
+    async def get_data(self, key):
+        _, record = await self._load(key)
+        return copy.copy(record[1])
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
@@ -0,0 +1,361 @@
+from collections import namedtuple
+from types import MappingProxyType
+
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+
+class SurveyStates(StatesGroup):
+    check_sub = State()
+    q1_sphere = State()
+    q2_support = State()
+    q3_group_attitude = State()
+    intensive_intro = State()
+    day_1 = State()
+    day_2 = State()
+    day_3 = State()
+    sales_main = State()
+    sales_group_select = State()
+    sales_individual = State()
+
+
+Step = namedtuple("Step", ["text", "markup", "state"])
+
+CONTACT = "@doctorkashcheeva"
+CHANNEL_URL = "https://t.me/doctor_kashcheeva"
+
+Q2_QUESTION = "Когда вам становится тяжело, вы обычно ищете поддержку?"
+Q3_QUESTION = "Как вы относитесь к идее пройти терапевтическую группу?"
+
+# Ответы на вопросы: callback_data -> (текст для логов, реакция бота, которая предваряет следующий вопрос)
+ANSWERS = {
+    "q1": {
+        "q1_food": ("Еда и тело", "Это частая трудность. В программе можно научиться справляться с перееданием и критикой к себе."),
+        "q1_money": ("Деньги", "Деньги связаны не только с цифрами, но и с эмоциями. В программе о финансовой устойчивости мы работаем как раз с этим."),
+        "q1_confidence": ("Уверенность", "Уверенность можно укрепить - в группе проще увидеть свои сильные стороны."),
+        "q1_relations": ("Отношения", "В терапии часто оказывается, что трудности в отношениях решаемы, если понимать свои эмоции и реакции."),
+        "q1_habits": ("Привычки", "Справляться с привычками одному сложно, а в группе появляется поддержка и конкретные шаги."),
+    },
+    "q2": {
+        "q2_inside": ("Держу в себе", "Это выматывает. В терапии не нужно тащить всё в одиночку."),
+        "q2_friends": ("С близкими", "Это ценно, но они не всегда могут дать именно то, что поможет. Группа - безопасное пространство, где поддержка идет вместе с профессиональными инструментами."),
+        "q2_pro": ("К специалисту", "Отлично, значит вы уже заботитесь о себе. Групповой формат может стать дополнением и ускорить изменения."),
+    },
+    "q3": {
+        "q3_now": ("Хочу сейчас", "Это сильный шаг. Я расскажу какая из программ подойдёт вам: стройность, финансы, самооценка, отношения или работа с зависимостями."),
+        "q3_think": ("Думаю", "Это естественно. Но как раз в группе проще не откладывать, потому что есть поддержка и конкретный план."),
+        "q3_unsure": ("Нет уверенности", "Можно начать с небольшой группы. Это безопасный способ попробовать терапию и увидеть первые результаты."),
+    },
+}
+
+INTENSIVE_OFFER = (
+    "Каждый ваш ответ - это про заботу о себе. Я предлагаю вам пройти небольшой бесплатный 3-х дневный интенсив, "
+    "в котором вас ждут три коротких видео урока (по 20-30 мин) и простые практические задания, которые помогут:\n"
+    "- понять что именно мешает вам двигаться вперед\n"
+    "- научиться управлять внутренним саботажем и эмоциями\n"
+    "- сделать первый шаг к устойчивым изменениям"
+)
+
+TOPICS = {
+    "body": ("Стройность", (
+        "Эта группа для тех, кто устал от диет, срывов и чувство вины. Мы работаем не с весами, а с привычками, мыслями и эмоциями.\n"
+        "Вы научитесь понимать сигналы тела, справляться с перееданием и строить новые отношения с едой без жёстких ограничений.\n"
+        "Хотите присоединиться к ближайшей группе?"
+    )),
+    "money": ("Финансы", (
+        "Финансовые трудности часто связаны не только с цифрами, но и с нашими мыслями, страхами и привычками. "
+        "В группе мы работаем с тревогой о деньгах, откладыванием, с причинами Долгов и с внутренними запретами на доход. "
+        "Это шаг к спокойствию и большой уверенности в завтрашнем дне. Хотите я расскажу о ближайшем наборе?"
+    )),
+    "self": ("Самооценка", (
+        "Если вы часто сомневаетесь в себе, откладывайте из-за страха ошибки или живёте с внутренним критиком – эта группа поможет.\n"
+        "Вы будете учиться замечать свои сильные стороны, справляться с самокритикой и шага за шагом укреплять уверенность."
+    )),
+    "rel": ("Отношения", (
+        "Близкие отношения это источник поддержки, но часто и боли. В группе мы работаем с доверием, умением строить здоровые границы, "
+        "понимать свои чувства и не терять себя в отношениях.\n"
+        "Это пространство, где можно увидеть привычные сценарии и начать строить новые, более здоровые.\n"
+        "Хотите узнать о ближайшей группе?"
+    )),
+    "habits": ("Негативные привычки", (
+        "Иногда привычки становится слишком сильными и начинают управлять нами – это могут быть еда, гаджеты, алкоголь или другие формы зависимости. "
+        "В группе мы разбираем как устроены такие механизмы и учимся шаг за шагом возвращать себе контроль. Хотите присоединиться к ближайшей группе?"
+    )),
+}
+
+# Шаги воронки: текст, кнопки (callback_data или url) и состояние FSM, в которое переходит пользователь.
+# Всё описание компилируется один раз при импорте в неизменяемые Step с готовой разметкой.
+FUNNEL = {
+    "welcome": {
+        "text": (
+            "Здравствуйте! Если вы здесь, значит хотите перемен – разобраться в себе, чувствах или привычках.\n"
+            "Ответьте на несколько вопросов и я подскажу, какой путь подойдёт именно вам и открою доступ к "
+            "3-х дневному мини-интенсиву, который поможет почувствовать первые изменения."
+        ),
+        "buttons": [("Пройти опрос", "start_flow")],
+    },
+    "subscribe": {
+        "text": (
+            "Чтобы я могла вам помочь, сначала подпишитесь на мой ТГ канал, "
+            "там вы найдёте много полезной информации."
+        ),
+        "buttons": [("Подписаться", {"url": CHANNEL_URL}), ("Начать диагностику", "check_sub_again")],
+    },
+    "q1": {
+        "text": "С какой сферой сейчас труднее всего справляться?",
+        "buttons": [
+            ("С отношением к еде и телу", "q1_food"),
+            ("С деньгами и ощущением стабильности", "q1_money"),
+            ("С уверенностью в себе", "q1_confidence"),
+            ("С отношениями с близкими", "q1_relations"),
+            ("С привычками от которых сложно отказаться", "q1_habits"),
+        ],
+        "state": SurveyStates.q1_sphere,
+    },
+    "q2": {
+        "text": Q2_QUESTION,
+        "buttons": [
+            ("Держу в себе", "q2_inside"),
+            ("Стараюсь обсудить с близкими", "q2_friends"),
+            ("Обращаюсь к специалисту", "q2_pro"),
+        ],
+        "state": SurveyStates.q2_support,
+    },
+    "q3": {
+        "text": Q3_QUESTION,
+        "buttons": [
+            ("Хочу начать уже сейчас", "q3_now"),
+            ("Думаю, но пока откладываю", "q3_think"),
+            ("Интересно, но нет уверенности", "q3_unsure"),
+            ("⬅️ Назад", "back_to_q2"),
+        ],
+        "state": SurveyStates.q3_group_attitude,
+    },
+    "intensive_offer": {
+        "text": INTENSIVE_OFFER,
+        "buttons": [("Начать интенсив", "start_intensive"), ("⬅️ Назад", "back_to_q3")],
+        "state": SurveyStates.intensive_intro,
+    },
+    "day_1": {
+        "text": (
+            "Меня зовут Анастасия Кащеева – я психотерапевт, когнитивно-поведенческий терапевт и автор проектов о том, как вернуть себе опору, ясность и устойчивость в жизни.\n\n"
+            "Добро пожаловать на бесплатный интенсив \"пять ключей к изменениям\".\n"
+            "В течение нескольких дней мы разберём, почему даже сильные и умные люди часто застревают в теле, в отношениях, с деньгами, с привычками или самооценкой – и что с этим можно сделать.\n\n"
+            "После интенсива вы увидите, в какой сфере сейчас ваша главная точка роста - И сможете выбрать подходящую группу для продолжения работы.\n\n"
+            "Урок 1 (видео)\n"
+            "Почему мы знаем что делать – но не делаем: как работает внутренний саботаж\n\n"
+            "Я покажу вам, что причина не в слабой воле или лени, а в автоматических мыслях, страхи неудачи и неосознанных установках. Здесь работает простая схема КПТ: мысль-> эмоция-> поведение.\n\n"
+            "Типичные формы самосаботажа: откладывание, переедание, избегание, раздражение, всё или ничего.\n\n"
+            "Задание на самонаблюдение - поймать момент саботажа.\n"
+            "Это затрагивает всех: и тех кто не может начать худеть, и тех кто застрял в отношениях, с деньгами или самооценкой.\n\n"
+            "В течение дня замечаете ситуацию, где вы хотели сделать что-то полезное (например, заняться спортом, поговорить спокойно, не переесть, не тратить лишнего) но не смогли.\n\n"
+            "Запишите три пункта:\n"
+            "- что я собирался(лась) сделать?\n"
+            "- какая мысль мелькнула в голове перед тем, как я передумал(а)?\n"
+            "- какое чувство появилось?\n\n"
+            "Коротко проанализируйте помогла ли вам эта мысль приблизиться к цели или отдалила?\n\n"
+            "Цель: увидеть, что саботаж – не лень, а автоматическая мысль, которую можно заметить и поменять."
+        ),
+        "state": SurveyStates.day_1,
+    },
+    "day_1_prompt": {
+        "text": "Нажмите Готово после того, как выполните задание.",
+        "buttons": [("Готово", "day1_done")],
+    },
+    "day_2": {
+        "text": (
+            "Урок 2 (видео)\n\n"
+            "Эмоции под контролем: как перестать жить на автопилоте.\n\n"
+            "Покажу вам, что эмоции не враги, а сигналы, которые можно научиться понимать и использовать.\n\n"
+            "Научу различать автоматическую эмоцию и её причину.\n\n"
+            "Почему избегание чувств усиливает тревогу, переедания и конфликты.\n\n"
+            "Эта тема универсальная для всех направлений потому что эмоции – главные триггеры поведения.\n\n"
+            "Задание Стоп-кадр:\n"
+            "В течение второго дня, когда почувствуете сильную эмоцию (тревога, раздражение, обида) - остановитесь на 30 секунд.\n\n"
+            "Ответьте письменно:\n"
+            "- что я сейчас чувствую (одним словом)?\n"
+            "- что произошло перед этим?\n"
+            "- о чем говорит эта эмоция, чего я хочу или чего мне не хватает?\n\n"
+            "Сделайте глубокий вдох-выдох и выберите одно маленькое действие, которое поможет вам удовлетворить эту потребность экологично.\n\n"
+            "Цель: научиться распознавать эмоцию до того, как она направит поведение."
+        ),
+        "state": SurveyStates.day_2,
+    },
+    "day_2_prompt": {
+        "text": "Нажмите Готово после того, как выполните задание и смотрите завершающий урок интенсива",
+        "buttons": [("Готово", "day2_done")],
+    },
+    "day_3": {
+        "text": (
+            "Поздравляю вас, сегодня завершающий день мини интенсива.\n\n"
+            "Урок 3 (видео)\n\n"
+            "Как строятся устойчивые изменения: шаги, которые работают.\n\n"
+            "Сегодня будем учиться переводить себя из позиции \"я опять не справлюсь\" в состояние \"я понимаю как работает процесс изменений\".\n\n"
+            "Узнаем, как мозг реагирует на новое и почему быстро откатывает обратно.\n\n"
+            "Задание: одно действие на сегодня.\n\n"
+            "Выберите одну сферу, где вы давно хотите изменений (тело, отношения, финансы, привычки или самооценка).\n\n"
+            "Запишите одно маленькое действие, которое реально сделать за 5-10 минут и которое немного приблизить вас к цели.\n\n"
+            "Например: выпить стакан воды вместо кофе, написать сообщение, записать расходы, выйти на короткую прогулку, похвалить себя.\n\n"
+            "Вечером отметьте, удалось ли сделать. Если да – замечайте чувство удовлетворения, если нет – мягко проанализируйте, что помешало.\n\n"
+            "Цель: почувствовать, что изменения начинаются не с мотивации, а с маленьких, осознанных действий."
+        ),
+        "state": SurveyStates.day_3,
+    },
+    "day_3_prompt": {
+        "text": "Нажмите Завершить после того, как выполните задание.",
+        "buttons": [("Завершить интенсив", "intensive_complete")],
+    },
+    "sales_main": {
+        "text": (
+            "Вы сделали первый шаг к решению вашей проблемы. Сейчас я веду набор в групповые программы по 5 направлениям: "
+            "стройность, финансы, самооценка, отношения и зависимости.\n"
+            "Хотите расскажу подробнее о той, которая подходит именно вам?"
+        ),
+        "buttons": [
+            ("Да, хочу в группу", "sales_group"),
+            ("Хочу работать индивидуально", "sales_indiv"),
+            ("Есть вопросы", "sales_questions"),
+        ],
+        "state": SurveyStates.sales_main,
+    },
+    "sales_group": {
+        "text": (
+            "Здорово! У меня есть несколько направлений терапевтических групп:\n"
+            "- Стройность через КПТ-для тех, кто хочет наладить отношения с едой и телом\n"
+            "- Финансовая устойчивость-про деньги и уверенность в себе\n"
+            "- Самооценка и уверенность-чтобы чувствовать больше опоры в себе\n"
+            "- Отношения-про близость, доверие и здоровые границы\n"
+            "- Работа с зависимостями-для тех, кто устал жить \"по кругу\"\n\n"
+            "Выберите какая тема ближе вам сейчас и я расскажу подробнее о ближайшем наборе."
+        ),
+        "buttons": [
+            ("Стройность", "topic_body"),
+            ("Финансы", "topic_money"),
+            ("Самооценка", "topic_self"),
+            ("Отношения", "topic_rel"),
+            ("Негативные привычки", "topic_habits"),
+            ("⬅️ Назад", "back_to_sales_main"),
+        ],
+        "state": SurveyStates.sales_group_select,
+    },
+    "topic": {
+        "text": "",
+        "buttons": [("Да, хочу в группу", "final_yes"), ("Задать вопрос", "final_q")],
+    },
+    "final_yes": {
+        "text": f"Если вы чувствуете, что формат группы вам подходит – можно занять место прямо сейчас. Напишите мне и я пришлю все детали: {CONTACT}",
+    },
+    "final_q": {
+        "text": f"Если у вас есть вопрос, напишите мне: {CONTACT}",
+    },
+    "sales_indiv": {
+        "text": (
+            "Индивидуальная работа – это безопасное пространство, где все внимание уделяется только вам.\n\n"
+            "На сессиях мы разбираем именно ваш запрос и шаг за шагом идём к изменениям. "
+            "Индивидуальные консультации проходят онлайн и очно (в центре Москвы).\n"
+            "Длительность консультации 50 минут. Рекомендуемая частота – обычно один раз в неделю. "
+            "В среднем от 8 до 20 встреч уже достаточно чтобы почувствовать результат. "
+            "Хотите я помогу подобрать удобное время для первой консультации?\n\n"
+            "Чтобы согласовать удобное время и условия индивидуальной работы с вами, а также уточнить условия – напишите мне:\n"
+            f"{CONTACT}"
+        ),
+    },
+    "sales_questions": {
+        "text": (
+            "Сомневаться и уточнять нормально. Можете просто написать мне, чтобы задать вопрос или обсудить, "
+            "какой формат ближе именно вам:\n"
+            f"{CONTACT}"
+        ),
+    },
+}
+
+
+def build_markup(buttons):
+    if not buttons:
+        return None
+    rows = []
+    for text, target in buttons:
+        if isinstance(target, dict):
+            rows.append([InlineKeyboardButton(text=text, **target)])
+        else:
+            rows.append([InlineKeyboardButton(text=text, callback_data=target)])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def compile_funnel(funnel):
+    steps = {}
+    for name, spec in funnel.items():
+        steps[name] = Step(spec["text"], build_markup(spec.get("buttons")), spec.get("state"))
+    return MappingProxyType(steps)
+
+
+def compile_variants(step, answers, template):
+    # Один Step на каждый предыдущий ответ: реакция на ответ + следующий вопрос, с общей разметкой
+    variants = {None: step._replace(text=template.format(intro="", text=step.text))}
+    for choice, (_, intro) in answers.items():
+        variants[choice] = step._replace(text=template.format(intro=intro, text=step.text))
+    return MappingProxyType(variants)
+
+
+STEPS = compile_funnel(FUNNEL)
+Q2_BY_Q1 = compile_variants(STEPS["q2"], ANSWERS["q1"], "{intro}\n\n{text}")
+Q3_BY_Q2 = compile_variants(STEPS["q3"], ANSWERS["q2"], "{intro}\n\n{text}")
+OFFER_BY_Q3 = compile_variants(STEPS["intensive_offer"], ANSWERS["q3"], "{intro}\n\n{text}")
+TOPIC_STEPS = MappingProxyType({
+    key: STEPS["topic"]._replace(text=text) for key, (_, text) in TOPICS.items()
+})
+
+
+# Коды событий для аналитики: "шаг" или "шаг:вариант" (q1:food, topic:money, final:yes).
+# Порядок шагов задаёт конверсию в /stats; у вариантов шаг берётся из префикса до двоеточия.
+FUNNEL_ORDER = (
+    ("start", "Запустили /start"),
+    ("start_flow", "Нажали «Пройти опрос»"),
+    ("q1", "Ответили на вопрос 1"),
+    ("q2", "Ответили на вопрос 2"),
+    ("q3", "Ответили на вопрос 3"),
+    ("day_1", "Начали День 1"),
+    ("day_2", "Перешли ко Дню 2"),
+    ("day_3", "Перешли ко Дню 3"),
+    ("intensive_complete", "Завершили интенсив"),
+    ("sales", "Выбрали формат"),
+    ("topic", "Выбрали тему группы"),
+    ("final", "Нажали финальную кнопку"),
+)
+
+# Подписи вариантов без отдельных текстов ответов: для отчёта админам
+SALES_LABELS = {"group": "Группа", "indiv": "Индивидуальная работа", "questions": "Есть вопросы"}
+FINAL_LABELS = {"yes": "Хочу в группу", "q": "Задать вопрос"}
+
+
+def event_code(callback_data):
+    return callback_data.replace("_", ":", 1)
+
+
+def answer_label(question, choice):
+    answer = ANSWERS[question].get(choice)
+    return answer[0] if answer else choice
+
+
+def summary_fields(summary):
+    # Поля снимка user_summary в человекочитаемом виде: строки отчёта и колонки дайджеста
+    q1, q2, q3, day, topic, sales, final, started_at, intensive_done_at, finished_at, updated_at = summary
+    return [
+        ("Сфера", answer_label("q1", f"q1_{q1}") if q1 else "—"),
+        ("Поддержка", answer_label("q2", f"q2_{q2}") if q2 else "—"),
+        ("Отношение к группе", answer_label("q3", f"q3_{q3}") if q3 else "—"),
+        ("Интенсив", f"завершён {intensive_done_at}" if intensive_done_at else f"день {day} из 3" if day else "не начат"),
+        ("Формат", SALES_LABELS.get(sales, sales) if sales else "—"),
+        ("Тема", TOPICS[topic][0] if topic in TOPICS else topic or "—"),
+        ("Финал", FINAL_LABELS.get(final, final) if final else "—"),
+        ("Начал", started_at or "—"),
+        ("Завершил", finished_at or "—"),
+        ("Последнее действие", updated_at or "—"),
+    ]
+
+
+def terminal_label(code):
+    # final:yes -> «Хочу в группу», sales:indiv -> «Индивидуальная работа»
+    step, _, variant = code.partition(":")
+    labels = FINAL_LABELS if step == "final" else SALES_LABELS
+    return labels.get(variant, code)
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import time
+
+# Отсчёт от импорта этого модуля: main.py импортирует его первым, поэтому сюда входит и импорт aiogram
+PROCESS_STARTED = time.perf_counter()
+
+from aiogram import BaseMiddleware
+
+
+class Lifecycle:
+    # Хуки старта идут этапами: этапы по порядку, хуки внутри этапа параллельно.
+    # Хуки остановки выполняются в обратном порядке регистрации, ошибка одного не мешает остальным
+    def __init__(self):
+        self.stages = []
+        self.shutdown_hooks = []
+        self.timings = {}
+        self.ready_after = None
+        self.first_update_after = None
+
+    def on_startup(self, hooks):
+        self.stages.append(hooks)
+
+    def on_shutdown(self, name, hook):
+        self.shutdown_hooks.append((name, hook))
+
+    async def _timed(self, name, hook):
+        started = time.perf_counter()
+        await hook()
+        self.timings[name] = time.perf_counter() - started
+
+    async def startup(self):
+        for stage in self.stages:
+            await asyncio.gather(*(self._timed(name, hook) for name, hook in stage.items()))
+        self.ready_after = time.perf_counter() - PROCESS_STARTED
+        logging.info(
+            "Старт за %.2f с (%s)",
+            self.ready_after,
+            ", ".join(f"{name} {seconds:.2f} с" for name, seconds in self.timings.items()),
+        )
+
+    async def shutdown(self):
+        for name, hook in reversed(self.shutdown_hooks):
+            try:
+                await hook()
+            except Exception:
+                logging.exception("Ошибка при остановке: %s", name)
+
+    def first_update(self):
+        if self.first_update_after is None:
+            self.first_update_after = time.perf_counter() - PROCESS_STARTED
+            logging.info("Первый апдейт через %.2f с после запуска процесса", self.first_update_after)
+
+
+class FirstUpdateMiddleware(BaseMiddleware):
+    def __init__(self, lifecycle):
+        self.lifecycle = lifecycle
+
+    async def __call__(self, handler, event, data):
+        if self.lifecycle.first_update_after is None:
+            self.lifecycle.first_update()
+        return await handler(event, data)
@@ -1,80 +1,126 @@
 import asyncio
 import logging
+import signal
 import sqlite3
 import datetime
+import html
 from contextlib import suppress
+from lifecycle import Lifecycle, FirstUpdateMiddleware
 from aiogram import Bot, Dispatcher, F, Router, types
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, BufferedInputFile
 from aiogram.exceptions import TelegramBadRequest
-from config import BOT_TOKEN, ADMIN_IDS, CHANNEL_ID, VIDEO_WELCOME_ID, VIDEO_LESSON_1_ID, VIDEO_LESSON_2_ID, VIDEO_LESSON_3_ID
-from database import db
-
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from config import BOT_TOKEN, ADMIN_IDS, CHANNEL_ID, FSM_CACHE_SIZE, FSM_FLUSH_INTERVAL_MS, MEDIA_DIR, MEDIA_UPLOAD_CHAT_ID
+from config import LOG_RETENTION_DAYS, LOG_RETENTION_INTERVAL, UPDATE_CONCURRENCY, INTENSIVE_DRIP_HOURS, WORKER_INDEX, WORKER_COUNT, WORKER_PORT
+from config import METRICS_HOST, METRICS_PORT, REPORT_GZIP_THRESHOLD, REPORT_DEDUP_WINDOW, REPORT_DIGEST_INTERVAL, REPORT_DIGEST_SIZE, REPORT_IMMEDIATE_CODES, SUBSCRIPTION_POSITIVE_TTL, SUBSCRIPTION_NEGATIVE_TTL, SUBSCRIPTION_CACHE_SIZE, TELEGRAM_API_URL, WEBHOOK_ENABLED, WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE
+from broadcast import BroadcastEngine
+from database import db, MATCH_START, MATCH_END
+from delivery import DeliveryQueue
+from digest import ReportDigest
+from fsm_storage import SQLiteStorage
+from media import MediaRegistry
+from funnel import SurveyStates, STEPS, ANSWERS, Q2_BY_Q1, Q3_BY_Q2, OFFER_BY_Q3, TOPICS, TOPIC_STEPS, FUNNEL_ORDER, answer_label, event_code, summary_fields
+from metrics import REGISTRY, HandlerMetricsMiddleware, start_metrics_server
+from reminders import ReminderScheduler
+from retention import LogRetention
+from sender import OutboundQueue, OutboundMiddleware, PRIORITY_REPORT, LANE_NAMES
+from sharding import shard_of
+from subscription import SubscriptionCache
+from update_scheduler import UserSerialMiddleware
+from webhook import WebhookServer
+
+def create_bot(token, outbound):
+    if TELEGRAM_API_URL:
+        bot = Bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    else:
+        bot = Bot(token=token)
+    bot.session.middleware(OutboundMiddleware(outbound))
+    return bot
+
+# Общий лимит Telegram (~30 msg/s) на бота делится между процессами супервизора поровну
+outbound = OutboundQueue(global_rate=30 / WORKER_COUNT)
+# Без BOT_TOKEN модуль всё равно импортируется (инструменты, проверки хендлеров); запуск main() без токена — ошибка
+bot = create_bot(BOT_TOKEN, outbound) if BOT_TOKEN else None
+storage = SQLiteStorage(db, cache_size=FSM_CACHE_SIZE, flush_interval_ms=FSM_FLUSH_INTERVAL_MS)
+serial = UserSerialMiddleware(max_concurrency=UPDATE_CONCURRENCY)
+dp = Dispatcher(storage=storage, events_isolation=serial.isolation)
+lifecycle = Lifecycle()
+# FSMContextMiddleware переставляем в конец: повторные нажатия снимаются до очереди на замок пользователя, состояние читается под замком
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(FirstUpdateMiddleware(lifecycle))
+dp.update.outer_middleware(serial)
+dp.update.outer_middleware(dp.fsm)
 router = Router()
 admin_router = Router()
 dp.include_router(admin_router)
 dp.include_router(router)
+reminders = ReminderScheduler(bot, db, outbound, owns=lambda user_id: shard_of(user_id, WORKER_COUNT) == WORKER_INDEX)
+db.interaction_listeners.append(reminders.touch)
+broadcasts = BroadcastEngine(bot, db, outbound)
+media = MediaRegistry(bot, db, MEDIA_DIR, MEDIA_UPLOAD_CHAT_ID)
+delivery = DeliveryQueue(bot, db, outbound, media, owns=lambda user_id: shard_of(user_id, WORKER_COUNT) == WORKER_INDEX)
+retention = LogRetention(db, LOG_RETENTION_DAYS, LOG_RETENTION_INTERVAL)
+digest = ReportDigest(bot, db, outbound, ADMIN_IDS, REPORT_DIGEST_INTERVAL, REPORT_DIGEST_SIZE) if REPORT_DIGEST_INTERVAL else None
+subscriptions = SubscriptionCache(bot, CHANNEL_ID, positive_ttl=SUBSCRIPTION_POSITIVE_TTL, negative_ttl=SUBSCRIPTION_NEGATIVE_TTL, max_size=SUBSCRIPTION_CACHE_SIZE)
+
+for observed_router in (admin_router, router):
+    observed_router.message.middleware(HandlerMetricsMiddleware())
+    observed_router.callback_query.middleware(HandlerMetricsMiddleware())
+REGISTRY.gauge("bot_startup_seconds", "Длительность хуков старта", lambda: lifecycle.timings, "hook")
+REGISTRY.gauge("bot_time_to_first_update_seconds", "Время от запуска процесса до первого апдейта", lambda: lifecycle.first_update_after or 0)
+REGISTRY.gauge("bot_reminder_queue_depth", "Пользователи, ожидающие напоминания", lambda: len(reminders))
+REGISTRY.gauge("bot_scheduled_messages", "Отложенные сообщения, ожидающие отправки", lambda: len(delivery))
+REGISTRY.gauge("bot_outbound_queue_depth", "Сообщения в очереди на отправку", lambda: dict(zip(LANE_NAMES, outbound.queue_depth())), "lane")
+REGISTRY.gauge("bot_outbound_total", "Итоги отправки исходящих сообщений", lambda: dict(outbound.stats), "result")
+REGISTRY.gauge("bot_event_buffer_depth", "Строки логов, ещё не записанные в БД", lambda: db.events.queue.qsize())
+REGISTRY.gauge("bot_updates_in_progress", "Апдейты, которые сейчас обрабатываются", lambda: serial.active)
+REGISTRY.gauge("bot_updates_dropped_total", "Отброшенные повторные нажатия", lambda: serial.dropped)
+REGISTRY.gauge("bot_logs_archived_total", "Строки логов, перенесённые в архив", lambda: retention.archived)
+REGISTRY.gauge("bot_reports_digested_total", "Отчёты, отправленные админам в дайджесте", lambda: digest.reported if digest else 0)
+REGISTRY.gauge("bot_fsm_cache_total", "Попадания и промахи кэша FSM", lambda: {"hit": storage.hits, "miss": storage.misses}, "result")
+REGISTRY.gauge("bot_user_cache_total", "Попадания и промахи кэша профилей", lambda: {"hit": db.user_hits, "miss": db.user_misses}, "result")
+REGISTRY.gauge("bot_subscription_cache_total", "Попадания и промахи кэша подписки", lambda: {"hit": subscriptions.hits, "miss": subscriptions.misses}, "result")
 
 
 
-class SurveyStates(StatesGroup):
-    check_sub = State()
-    q1_sphere = State()
-    q2_support = State()
-    q3_group_attitude = State()
-    intensive_intro = State()
-    day_1 = State()
-    day_2 = State()
-    day_3 = State()
-    sales_main = State()
-    sales_group_select = State()
-    sales_individual = State()
-
 class AdminStates(StatesGroup):
     viewing_list = State()
     entering_id = State()
 
-async def send_report_to_admins(user_id):
-    user_info = db.get_user_info(user_id)
+def render_report(user_id, first_name, username, summary):
+    lines = [
+        "Пользователь завершил воронку:",
+        f"ID: {user_id}",
+        f"Name: {first_name}",
+        f"Username: @{username}",
+        "",
+    ]
+    lines += [f"{title}: {value}" for title, value in summary_fields(summary)]
+    lines += ["", "Полная история: /conv → «Найти по ID»"]
+    return "\n".join(lines)
+
+async def send_report_to_admins(user_id, code):
+    # Повтор того же финального события в окне REPORT_DEDUP_WINDOW отчёта не порождает.
+    # В режиме дайджеста отчёт встаёт в очередь, отдельным сообщением уходят только REPORT_IMMEDIATE_CODES
+    if not await db.claim_report(user_id, code, REPORT_DEDUP_WINDOW, pending=digest is not None):
+        return
+    if digest is not None and code not in REPORT_IMMEDIATE_CODES:
+        return
+    user_info = await db.get_user_info(user_id)
     username = user_info[0] if user_info else "Unknown"
     first_name = user_info[1] if user_info else "Unknown"
-    
-    logs = db.get_user_logs(user_id)
-    report_text = f"Пользователь завершил воронку:\nID: {user_id}\nName: {first_name}\nUsername: @{username}\n\nИстория ответов:\n"
-    
-    for log in logs:
-        event, content, time = log
-        report_text += f"[{time}] {event}: {content}\n"
-
-    for admin_id in ADMIN_IDS:
-        try:
-            file = BufferedInputFile(report_text.encode("utf-8"), filename=f"report_{user_id}.txt")
-            await bot.send_document(admin_id, file, caption=f"Отчет по пользователю {first_name} (@{username})")
-        except Exception:
-            pass
-
-async def reminder_scheduler():
-    while True:
-        try:
-            users_to_remind = db.get_users_for_reminder()
-            for user_id in users_to_remind:
-                try:
-                    await bot.send_message(
-                        user_id, 
-                        "Здравствуйте! Я заметила, что вы не завершили наш диалог. "
-                        "Хотите продолжить путь к изменениям? Нажмите на последнюю кнопку или напишите /start, чтобы начать заново."
-                    )
-                    db.set_reminded(user_id)
-                except Exception:
-                    db.set_reminded(user_id) 
-            await asyncio.sleep(3)
-        except Exception:
-            await asyncio.sleep(3)
+
+    # Отчёт собирается из снимка user_summary, а не из всей истории логов
+    summary = await db.get_user_summary(user_id) or (None, None, None, 0) + (None,) * 7
+    text = render_report(user_id, first_name, username, summary)
+    await asyncio.gather(*(
+        outbound.send(bot.send_message, priority=PRIORITY_REPORT, chat_id=admin_id, text=text)
+        for admin_id in ADMIN_IDS
+    ), return_exceptions=True)
 
 @admin_router.message(Command("conv"))
 async def cmd_admin_conv(message: types.Message, state: FSMContext):
@@ -82,9 +128,17 @@ async def cmd_admin_conv(message: types.Message, state: FSMContext):
         return
     await show_users_page(message, 0)
 
-async def show_users_page(message: types.Message, page: int):
-    users = db.get_all_users_paginated(page)
-    total_count = db.get_user_count()
+def encode_page_cursor(row):
+    u_id, _, _, u_date = row
+    return f"{''.join(ch for ch in u_date if ch.isdigit())}_{u_id}"
+
+def decode_page_cursor(stamp, u_id):
+    joined_at = f"{stamp[:4]}-{stamp[4:6]}-{stamp[6:8]} {stamp[8:10]}:{stamp[10:12]}:{stamp[12:14]}"
+    return joined_at, int(u_id)
+
+async def show_users_page(message: types.Message, page: int, cursor=None, backward=False):
+    users = await db.get_users_page(cursor, backward)
+    total_count = await db.get_user_count()
     total_pages = (total_count + 9) // 10
     
     text = f"Всего пользователей: {total_count}. Страница {page + 1}/{total_pages}\n\n"
@@ -95,11 +149,12 @@ async def show_users_page(message: types.Message, page: int):
         display_name = f"{u_name} (@{u_username})" if u_username else f"{u_name}"
         text += f"ID: <code>{u_id}</code> | {display_name} | {u_date}\n"
     
+    # В callback_data лежит номер страницы и ключ крайней строки: adm_page_<page>_<p|n>_<joined_at>_<user_id>
     nav_buttons = []
-    if page > 0:
-        nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"adm_page_{page-1}"))
-    if page < total_pages - 1:
-        nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"adm_page_{page+1}"))
+    if page > 0 and users:
+        nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"adm_page_{page-1}_p_{encode_page_cursor(users[0])}"))
+    if page < total_pages - 1 and users:
+        nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"adm_page_{page+1}_n_{encode_page_cursor(users[-1])}"))
     
     if nav_buttons:
         kb_rows.append(nav_buttons)
@@ -117,8 +172,12 @@ async def admin_pagination(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         return
     await callback.answer()
-    page = int(callback.data.split("_")[2])
-    await show_users_page(callback.message, page)
+    parts = callback.data.split("_")
+    page = int(parts[2])
+    if len(parts) == 6 and page > 0:
+        await show_users_page(callback.message, page, decode_page_cursor(parts[4], parts[5]), backward=parts[3] == "p")
+    else:
+        await show_users_page(callback.message, 0)
 
 @admin_router.callback_query(F.data == "adm_search_id")
 async def admin_ask_id(callback: types.CallbackQuery, state: FSMContext):
@@ -134,51 +193,135 @@ async def admin_show_logs(message: types.Message, state: FSMContext):
         return
     try:
         target_id = int(message.text.strip())
-        logs = db.get_user_logs(target_id)
-        if not logs:
+        payload, compressed = await db.export_user_logs(target_id, f"История диалога с {target_id}:\n\n", REPORT_GZIP_THRESHOLD, include_archive=True)
+        if payload is None:
             await message.answer("Логов по этому пользователю нет.")
         else:
-            file_content = f"История диалога с {target_id}:\n\n"
-            for log in logs:
-                event, content, time = log
-                file_content += f"[{time}] {event}: {content}\n"
-            
-            file = BufferedInputFile(file_content.encode("utf-8"), filename=f"log_{target_id}.txt")
-            await message.answer_document(file)
+            file = BufferedInputFile(payload, filename=f"log_{target_id}.txt.gz" if compressed else f"log_{target_id}.txt")
+            await outbound.send(bot.send_document, chat_id=message.chat.id, document=file)
             
     except ValueError:
         await message.answer("Некорректный ID.")
     
     await state.clear()
 
+@admin_router.message(Command("broadcast"))
+async def cmd_admin_broadcast(message: types.Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    if not command.args:
+        await message.answer("Напишите текст рассылки после команды: /broadcast <текст>")
+        return
+    progress = await message.answer("Рассылка запускается...")
+    broadcast_id = await broadcasts.start(message.from_user.id, command.args, progress)
+    await message.answer(f"Рассылка #{broadcast_id} запущена. Остановить: /broadcast_stop {broadcast_id}")
+
+@admin_router.message(Command("broadcast_stop"))
+async def cmd_admin_broadcast_stop(message: types.Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    if command.args and command.args.strip().isdigit() and broadcasts.cancel(int(command.args.strip())):
+        await message.answer("Рассылка будет остановлена.")
+    else:
+        await message.answer("Активная рассылка с таким номером не найдена.")
+
+@admin_router.message(Command("stats"))
+async def cmd_admin_stats(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    # Только предагрегированные таблицы: время ответа не зависит от размера logs
+    totals = dict((code, (events, users)) for code, events, users in await db.get_funnel_totals())
+    today = dict((code, users) for code, _, users in await db.get_funnel_daily(datetime.date.today().isoformat()))
+
+    lines = ["Воронка (уникальные пользователи, всего / сегодня, конверсия из предыдущего шага):"]
+    previous = None
+    for code, title in FUNNEL_ORDER:
+        users = totals.get(code, (0, 0))[1]
+        conversion = f" ({users * 100 / previous:.0f}%)" if previous else ""
+        lines.append(f"{title}: {users} / {today.get(code, 0)}{conversion}")
+        previous = users
+
+    for step, title in (("q1", "Сфера"), ("q2", "Поддержка"), ("q3", "Отношение к группе"), ("topic", "Тема"), ("sales", "Формат"), ("final", "Финал")):
+        answers = sorted(
+            ((code.split(":", 1)[1], users) for code, (_, users) in totals.items() if code.startswith(step + ":")),
+            key=lambda item: -item[1],
+        )
+        if answers:
+            lines.append("")
+            lines.append(f"{title}: " + ", ".join(f"{answer} – {users}" for answer, users in answers))
+
+    await message.answer("\n".join(lines))
+
+@admin_router.message(Command("find"))
+async def cmd_admin_find(message: types.Message, command: CommandObject, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    if not command.args:
+        await message.answer("Напишите запрос после команды: /find <ник, имя или текст из логов>")
+        return
+    # Запрос держим в FSM админа: в callback_data пагинации он может не поместиться
+    await state.update_data(find_query=command.args.strip())
+    await show_search_page(message, command.args.strip(), 0)
+
+async def show_search_page(message: types.Message, query: str, page: int, edit=False):
+    total, results = await db.search_users(query, limit=10, offset=page * 10)
+    if not total:
+        await message.answer("Ничего не найдено.")
+        return
+    total_pages = (total + 9) // 10
+
+    text = f"Найдено пользователей: {total}. Страница {page + 1}/{total_pages}\n\n"
+    for u_id, u_name, u_username, log_hits, snippet in results:
+        display_name = html.escape(f"{u_name} (@{u_username})" if u_username else f"{u_name}")
+        text += f"ID: <code>{u_id}</code> | {display_name}"
+        if log_hits:
+            text += f" | в логах: {log_hits}"
+        if snippet:
+            text += "\n    " + html.escape(snippet).replace(MATCH_START, "<b>").replace(MATCH_END, "</b>")
+        text += "\n"
+
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"adm_find_{page-1}"))
+    if page < total_pages - 1:
+        nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"adm_find_{page+1}"))
+    markup = InlineKeyboardMarkup(inline_keyboard=[nav_buttons]) if nav_buttons else None
+
+    if edit:
+        with suppress(TelegramBadRequest):
+            await message.edit_text(text, reply_markup=markup, parse_mode="HTML")
+    else:
+        await message.answer(text, reply_markup=markup, parse_mode="HTML")
+
+@admin_router.callback_query(F.data.startswith("adm_find_"))
+async def admin_search_pagination(callback: types.CallbackQuery, state: FSMContext):
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+    await callback.answer()
+    query = (await state.get_data()).get("find_query")
+    if query:
+        await show_search_page(callback.message, query, int(callback.data.split("_")[2]), edit=True)
+
 @router.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
-    db.add_or_update_user(message.from_user.id, message.from_user.username, message.from_user.first_name)
-    db.log_event(message.from_user.id, "Пользователь", "Запустил бота /start")
+    await db.add_or_update_user(message.from_user.id, message.from_user.username, message.from_user.first_name)
+    await db.log_event(message.from_user.id, "Пользователь", "Запустил бота /start", code="start")
     
     await state.clear()
-    text = (
-        "Здравствуйте! Если вы здесь, значит хотите перемен – разобраться в себе, чувствах или привычках.\n"
-        "Ответьте на несколько вопросов и я подскажу, какой путь подойдёт именно вам и открою доступ к "
-        "3-х дневному мини-интенсиву, который поможет почувствовать первые изменения."
-    )
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Пройти опрос", callback_data="start_flow")]
-    ])
-    await message.answer(text, reply_markup=kb)
-    db.log_event(message.from_user.id, "Бот", "Отправил приветствие")
+    step = STEPS["welcome"]
+    await message.answer(step.text, reply_markup=step.markup)
+    await db.log_event(message.from_user.id, "Бот", "Отправил приветствие")
 
 @router.callback_query(F.data == "start_flow")
 async def check_subscription(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.update_interaction(user_id)
-    db.log_event(user_id, "Действие", "Нажал кнопку 'Пройти опрос'")
+    await db.update_interaction(user_id)
+    await db.log_event(user_id, "Действие", "Нажал кнопку 'Пройти опрос'", code="start_flow")
     
     await callback.answer()
     
     try:
-        member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        if member.status in ["member", "administrator", "creator"]:
+        if await subscriptions.is_subscribed(user_id):
             await start_survey(callback, state)
         else:
             await ask_to_subscribe(callback)
@@ -186,28 +329,20 @@ async def check_subscription(callback: types.CallbackQuery, state: FSMContext):
         await ask_to_subscribe(callback)
 
 async def ask_to_subscribe(callback: types.CallbackQuery):
-    text = (
-        "Чтобы я могла вам помочь, сначала подпишитесь на мой ТГ канал, "
-        "там вы найдёте много полезной информации."
-    )
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Подписаться", url="https://t.me/doctor_kashcheeva")],
-        [InlineKeyboardButton(text="Начать диагностику", callback_data="check_sub_again")]
-    ])
-    
+    step = STEPS["subscribe"]
     with suppress(TelegramBadRequest):
-        await callback.message.edit_text(text, reply_markup=kb)
-    db.log_event(callback.from_user.id, "Бот", "Попросил подписку")
+        await callback.message.edit_text(step.text, reply_markup=step.markup)
+    await db.log_event(callback.from_user.id, "Бот", "Попросил подписку")
 
 @router.callback_query(F.data == "check_sub_again")
 async def recheck_subscription(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.update_interaction(user_id)
-    db.log_event(user_id, "Действие", "Нажал 'Начать диагностику' (проверка подписки)")
+    await db.update_interaction(user_id)
+    await db.log_event(user_id, "Действие", "Нажал 'Начать диагностику' (проверка подписки)")
     
     try:
-        member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        if member.status in ["member", "administrator", "creator"]:
+        # Пользователь говорит, что подписался, поэтому закэшированный отказ перепроверяем
+        if await subscriptions.is_subscribed(user_id, refresh_negative=True):
             await callback.answer("Спасибо за подписку!")
             await start_survey(callback, state)
         else:
@@ -216,493 +351,281 @@ async def recheck_subscription(callback: types.CallbackQuery, state: FSMContext)
     except Exception:
         await callback.answer("Вы еще не подписались!", show_alert=True)
 
-async def start_survey(callback: types.CallbackQuery, state: FSMContext):
-    await state.set_state(SurveyStates.q1_sphere)
-    text = "С какой сферой сейчас труднее всего справляться?"
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="С отношением к еде и телу", callback_data="q1_food")],
-        [InlineKeyboardButton(text="С деньгами и ощущением стабильности", callback_data="q1_money")],
-        [InlineKeyboardButton(text="С уверенностью в себе", callback_data="q1_confidence")],
-        [InlineKeyboardButton(text="С отношениями с близкими", callback_data="q1_relations")],
-        [InlineKeyboardButton(text="С привычками от которых сложно отказаться", callback_data="q1_habits")]
-    ])
-    
+@router.chat_member()
+async def on_channel_member_update(event: types.ChatMemberUpdated):
+    if subscriptions.is_channel(event.chat):
+        subscriptions.set_status(event.new_chat_member.user.id, event.new_chat_member.status)
+
+async def show_step(callback: types.CallbackQuery, state: FSMContext, step):
+    if step.state is not None:
+        await state.set_state(step.state)
     with suppress(TelegramBadRequest):
-        await callback.message.edit_text(text, reply_markup=kb)
-        
-    db.log_event(callback.from_user.id, "Бот", "Отправил вопрос 1 (Сфера)")
+        await callback.message.edit_text(step.text, reply_markup=step.markup)
+
+async def start_survey(callback: types.CallbackQuery, state: FSMContext):
+    await show_step(callback, state, STEPS["q1"])
+    await db.log_event(callback.from_user.id, "Бот", "Отправил вопрос 1 (Сфера)")
 
 @router.callback_query(SurveyStates.q1_sphere)
 async def process_q1(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.update_interaction(user_id)
+    await db.update_interaction(user_id)
     await callback.answer()
     
     choice = callback.data
-    
-    readable_map = {
-        "q1_food": "Еда и тело",
-        "q1_money": "Деньги",
-        "q1_confidence": "Уверенность",
-        "q1_relations": "Отношения",
-        "q1_habits": "Привычки"
-    }
-    log_text = readable_map.get(choice, choice)
-    db.log_event(user_id, "Выбор сферы", log_text)
+    await db.log_event(user_id, "Выбор сферы", answer_label("q1", choice), code=event_code(choice) if choice in ANSWERS["q1"] else None)
     
     await state.update_data(q1_choice=choice)
-    await state.set_state(SurveyStates.q2_support)
-    
-    text_map = {
-        "q1_food": "Это частая трудность. В программе можно научиться справляться с перееданием и критикой к себе.",
-        "q1_money": "Деньги связаны не только с цифрами, но и с эмоциями. В программе о финансовой устойчивости мы работаем как раз с этим.",
-        "q1_confidence": "Уверенность можно укрепить - в группе проще увидеть свои сильные стороны.",
-        "q1_relations": "В терапии часто оказывается, что трудности в отношениях решаемы, если понимать свои эмоции и реакции.",
-        "q1_habits": "Справляться с привычками одному сложно, а в группе появляется поддержка и конкретные шаги."
-    }
-    
-    intro_text = text_map.get(choice, "")
-    full_text = f"{intro_text}\n\nКогда вам становится тяжело, вы обычно ищете поддержку?"
-    
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Держу в себе", callback_data="q2_inside")],
-        [InlineKeyboardButton(text="Стараюсь обсудить с близкими", callback_data="q2_friends")],
-        [InlineKeyboardButton(text="Обращаюсь к специалисту", callback_data="q2_pro")]
-    ])
-    
-    with suppress(TelegramBadRequest):
-        await callback.message.edit_text(full_text, reply_markup=kb)
-    db.log_event(user_id, "Бот", "Отправил вопрос 2 (Поддержка)")
+    await show_step(callback, state, Q2_BY_Q1.get(choice, Q2_BY_Q1[None]))
+    await db.log_event(user_id, "Бот", "Отправил вопрос 2 (Поддержка)")
 
 @router.callback_query(SurveyStates.q2_support)
 async def process_q2(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.update_interaction(user_id)
+    await db.update_interaction(user_id)
     await callback.answer()
     
     choice = callback.data
-    
-    readable_map = {
-        "q2_inside": "Держу в себе",
-        "q2_friends": "С близкими",
-        "q2_pro": "К специалисту"
-    }
-    log_text = readable_map.get(choice, choice)
-    db.log_event(user_id, "Выбор поддержки", log_text)
+    await db.log_event(user_id, "Выбор поддержки", answer_label("q2", choice), code=event_code(choice) if choice in ANSWERS["q2"] else None)
     
     await state.update_data(q2_choice=choice)
-    await state.set_state(SurveyStates.q3_group_attitude)
-    
-    msg_text = ""
-    if choice == "q2_inside":
-        msg_text = "Это выматывает. В терапии не нужно тащить всё в одиночку."
-    elif choice == "q2_friends":
-        msg_text = "Это ценно, но они не всегда могут дать именно то, что поможет. Группа - безопасное пространство, где поддержка идет вместе с профессиональными инструментами."
-    elif choice == "q2_pro":
-        msg_text = "Отлично, значит вы уже заботитесь о себе. Групповой формат может стать дополнением и ускорить изменения."
-
-    full_text = f"{msg_text}\n\nКак вы относитесь к идее пройти терапевтическую группу?"
-    
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Хочу начать уже сейчас", callback_data="q3_now")],
-        [InlineKeyboardButton(text="Думаю, но пока откладываю", callback_data="q3_think")],
-        [InlineKeyboardButton(text="Интересно, но нет уверенности", callback_data="q3_unsure")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_q2")]
-    ])
-    
-    with suppress(TelegramBadRequest):
-        await callback.message.edit_text(full_text, reply_markup=kb)
-    db.log_event(user_id, "Бот", "Отправил вопрос 3 (Отношение к группе)")
+    await show_step(callback, state, Q3_BY_Q2.get(choice, Q3_BY_Q2[None]))
+    await db.log_event(user_id, "Бот", "Отправил вопрос 3 (Отношение к группе)")
 
 @router.callback_query(F.data == "back_to_q2")
 async def back_to_q2_handler(callback: types.CallbackQuery, state: FSMContext):
-    db.log_event(callback.from_user.id, "Навигация", "Назад к вопросу 2")
+    await db.log_event(callback.from_user.id, "Навигация", "Назад к вопросу 2")
     await callback.answer()
     
     data = await state.get_data()
-    q1_choice = data.get("q1_choice")
-    await state.set_state(SurveyStates.q2_support)
-    
-    text_map = {
-        "q1_food": "Это частая трудность. В программе можно научиться справляться с перееданием и критикой к себе.",
-        "q1_money": "Деньги связаны не только с цифрами, но и с эмоциями. В программе о финансовой устойчивости мы работаем как раз с этим.",
-        "q1_confidence": "Уверенность можно укрепить - в группе проще увидеть свои сильные стороны.",
-        "q1_relations": "В терапии часто оказывается, что трудности в отношениях решаемы, если понимать свои эмоции и реакции.",
-        "q1_habits": "Справляться с привычками одному сложно, а в группе появляется поддержка и конкретные шаги."
-    }
-    intro_text = text_map.get(q1_choice, "")
-    full_text = f"{intro_text}\n\nКогда вам становится тяжело, вы обычно ищете поддержку?"
-    
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Держу в себе", callback_data="q2_inside")],
-        [InlineKeyboardButton(text="Стараюсь обсудить с близкими", callback_data="q2_friends")],
-        [InlineKeyboardButton(text="Обращаюсь к специалисту", callback_data="q2_pro")]
-    ])
-    
-    with suppress(TelegramBadRequest):
-        await callback.message.edit_text(full_text, reply_markup=kb)
+    await show_step(callback, state, Q2_BY_Q1.get(data.get("q1_choice"), Q2_BY_Q1[None]))
 
 @router.callback_query(SurveyStates.q3_group_attitude, F.data.in_({"q3_now", "q3_think", "q3_unsure"}))
 async def process_q3(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.update_interaction(user_id)
+    await db.update_interaction(user_id)
     await callback.answer()
     
     choice = callback.data
+    await db.log_event(user_id, "Отношение к группе", answer_label("q3", choice), code=event_code(choice) if choice in ANSWERS["q3"] else None)
     
-    readable_map = {
-        "q3_now": "Хочу сейчас",
-        "q3_think": "Думаю",
-        "q3_unsure": "Нет уверенности"
-    }
-    log_text = readable_map.get(choice, choice)
-    db.log_event(user_id, "Отношение к группе", log_text)
-    
-    await state.set_state(SurveyStates.intensive_intro)
-    
-    msg_intro = ""
-    if choice == "q3_now":
-        msg_intro = "Это сильный шаг. Я расскажу какая из программ подойдёт вам: стройность, финансы, самооценка, отношения или работа с зависимостями."
-    elif choice == "q3_think":
-        msg_intro = "Это естественно. Но как раз в группе проще не откладывать, потому что есть поддержка и конкретный план."
-    elif choice == "q3_unsure":
-        msg_intro = "Можно начать с небольшой группы. Это безопасный способ попробовать терапию и увидеть первые результаты."
-    
-    text = (
-        f"{msg_intro}\n\n"
-        "Каждый ваш ответ - это про заботу о себе. Я предлагаю вам пройти небольшой бесплатный 3-х дневный интенсив, "
-        "в котором вас ждут три коротких видео урока (по 20-30 мин) и простые практические задания, которые помогут:\n"
-        "- понять что именно мешает вам двигаться вперед\n"
-        "- научиться управлять внутренним саботажем и эмоциями\n"
-        "- сделать первый шаг к устойчивым изменениям"
-    )
-    
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Начать интенсив", callback_data="start_intensive")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_q3")]
-    ])
-    
-    with suppress(TelegramBadRequest):
-        await callback.message.edit_text(text, reply_markup=kb)
-    db.log_event(user_id, "Бот", "Предложил интенсив")
+    await show_step(callback, state, OFFER_BY_Q3.get(choice, OFFER_BY_Q3[None]))
+    await db.log_event(user_id, "Бот", "Предложил интенсив")
 
 @router.callback_query(F.data == "back_to_q3")
 async def back_to_q3_handler(callback: types.CallbackQuery, state: FSMContext):
-    db.log_event(callback.from_user.id, "Навигация", "Назад к вопросу 3")
+    await db.log_event(callback.from_user.id, "Навигация", "Назад к вопросу 3")
     await callback.answer()
-    await state.set_state(SurveyStates.q3_group_attitude)
     data = await state.get_data()
-    q2_choice = data.get("q2_choice")
-    
-    msg_text = ""
-    if q2_choice == "q2_inside":
-        msg_text = "Это выматывает. В терапии не нужно тащить всё в одиночку."
-    elif q2_choice == "q2_friends":
-        msg_text = "Это ценно, но они не всегда могут дать именно то, что поможет. Группа - безопасное пространство, где поддержка идет вместе с профессиональными инструментами."
-    elif q2_choice == "q2_pro":
-        msg_text = "Отлично, значит вы уже заботитесь о себе. Групповой формат может стать дополнением и ускорить изменения."
-
-    full_text = f"{msg_text}\n\nКак вы относитесь к идее пройти терапевтическую группу?"
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Хочу начать уже сейчас", callback_data="q3_now")],
-        [InlineKeyboardButton(text="Думаю, но пока откладываю", callback_data="q3_think")],
-        [InlineKeyboardButton(text="Интересно, но нет уверенности", callback_data="q3_unsure")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_q2")]
-    ])
-    
-    with suppress(TelegramBadRequest):
-        await callback.message.edit_text(full_text, reply_markup=kb)
+    await show_step(callback, state, Q3_BY_Q2.get(data.get("q2_choice"), Q3_BY_Q2[None]))
 
 @router.callback_query(F.data == "start_intensive")
 async def start_intensive_day_1(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.update_interaction(user_id)
+    await db.update_interaction(user_id)
     await callback.answer() 
-    db.log_event(user_id, "Интенсив", "Начал День 1")
+    await db.log_event(user_id, "Интенсив", "Начал День 1", code="day_1")
     
-    await state.set_state(SurveyStates.day_1)
-    await bot.send_video(chat_id=user_id, video=VIDEO_WELCOME_ID, caption="Приветствие")
-    await asyncio.sleep(1)
-    
-    await bot.send_video(chat_id=user_id, video=VIDEO_LESSON_1_ID, caption="Урок 1")
-    await asyncio.sleep(1)
-    big_text = (
-        "Меня зовут Анастасия Кащеева – я психотерапевт, когнитивно-поведенческий терапевт и автор проектов о том, как вернуть себе опору, ясность и устойчивость в жизни.\n\n"
-        "Добро пожаловать на бесплатный интенсив \"пять ключей к изменениям\".\n"
-        "В течение нескольких дней мы разберём, почему даже сильные и умные люди часто застревают в теле, в отношениях, с деньгами, с привычками или самооценкой – и что с этим можно сделать.\n\n"
-        "После интенсива вы увидите, в какой сфере сейчас ваша главная точка роста - И сможете выбрать подходящую группу для продолжения работы.\n\n"
-        "Урок 1 (видео)\n"
-        "Почему мы знаем что делать – но не делаем: как работает внутренний саботаж\n\n"
-        "Я покажу вам, что причина не в слабой воле или лени, а в автоматических мыслях, страхи неудачи и неосознанных установках. Здесь работает простая схема КПТ: мысль-> эмоция-> поведение.\n\n"
-        "Типичные формы самосаботажа: откладывание, переедание, избегание, раздражение, всё или ничего.\n\n"
-        "Задание на самонаблюдение - поймать момент саботажа.\n"
-        "Это затрагивает всех: и тех кто не может начать худеть, и тех кто застрял в отношениях, с деньгами или самооценкой.\n\n"
-        "В течение дня замечаете ситуацию, где вы хотели сделать что-то полезное (например, заняться спортом, поговорить спокойно, не переесть, не тратить лишнего) но не смогли.\n\n"
-        "Запишите три пункта:\n"
-        "- что я собирался(лась) сделать?\n"
-        "- какая мысль мелькнула в голове перед тем, как я передумал(а)?\n"
-        "- какое чувство появилось?\n\n"
-        "Коротко проанализируйте помогла ли вам эта мысль приблизиться к цели или отдалила?\n\n"
-        "Цель: увидеть, что саботаж – не лень, а автоматическая мысль, которую можно заметить и поменять."
-    )
-    await bot.send_message(chat_id=user_id, text=big_text)
-    
-    prompt_text = "Нажмите Готово после того, как выполните задание."
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Готово", callback_data="day1_done")]
+    await state.set_state(STEPS["day_1"].state)
+    await delivery.schedule(user_id, [
+        (0, "send_media_group", {"media": ["welcome", "lesson_1"]}),
+        (1, "send_message", {"step": "day_1"}),
+        (1, "send_message", {"step": "day_1_prompt"}),
+    ])
+    await db.log_event(user_id, "Бот", "Отправил материалы Дня 1")
+
+async def schedule_day(user_id, day):
+    # При INTENSIVE_DRIP_HOURS материалы следующего дня приходят по расписанию, а не сразу после «Готово»
+    delay = INTENSIVE_DRIP_HOURS * 3600
+    if delay:
+        await outbound.send(bot.send_message, chat_id=user_id, text=f"Отлично! Материалы Дня {day} придут через {INTENSIVE_DRIP_HOURS} ч.")
+    await delivery.schedule(user_id, [
+        (delay, "send_video", {"video_key": f"lesson_{day}"}),
+        (delay, "send_message", {"step": f"day_{day}"}),
+        (delay, "send_message", {"step": f"day_{day}_prompt"}),
     ])
-    await bot.send_message(chat_id=user_id, text=prompt_text, reply_markup=kb)
-    db.log_event(user_id, "Бот", "Отправил материалы Дня 1")
 
 @router.callback_query(F.data == "day1_done")
 async def intensive_day_2(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.update_interaction(user_id)
+    await db.update_interaction(user_id)
     await callback.answer()
-    db.log_event(user_id, "Интенсив", "Выполнил День 1, перешел ко Дню 2")
-    
-    await state.set_state(SurveyStates.day_2)
+    await db.log_event(user_id, "Интенсив", "Выполнил День 1, перешел ко Дню 2", code="day_2")
     
-    await bot.send_video(chat_id=user_id, video=VIDEO_LESSON_2_ID, caption="Урок 2")
-    
-    text = (
-        "Урок 2 (видео)\n\n"
-        "Эмоции под контролем: как перестать жить на автопилоте.\n\n"
-        "Покажу вам, что эмоции не враги, а сигналы, которые можно научиться понимать и использовать.\n\n"
-        "Научу различать автоматическую эмоцию и её причину.\n\n"
-        "Почему избегание чувств усиливает тревогу, переедания и конфликты.\n\n"
-        "Эта тема универсальная для всех направлений потому что эмоции – главные триггеры поведения.\n\n"
-        "Задание Стоп-кадр:\n"
-        "В течение второго дня, когда почувствуете сильную эмоцию (тревога, раздражение, обида) - остановитесь на 30 секунд.\n\n"
-        "Ответьте письменно:\n"
-        "- что я сейчас чувствую (одним словом)?\n"
-        "- что произошло перед этим?\n"
-        "- о чем говорит эта эмоция, чего я хочу или чего мне не хватает?\n\n"
-        "Сделайте глубокий вдох-выдох и выберите одно маленькое действие, которое поможет вам удовлетворить эту потребность экологично.\n\n"
-        "Цель: научиться распознавать эмоцию до того, как она направит поведение."
-    )
-    await bot.send_message(chat_id=user_id, text=text)
-
-    prompt = "Нажмите Готово после того, как выполните задание и смотрите завершающий урок интенсива"
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Готово", callback_data="day2_done")]
-    ])
-    await bot.send_message(chat_id=user_id, text=prompt, reply_markup=kb)
-    db.log_event(user_id, "Бот", "Отправил материалы Дня 2")
+    await state.set_state(STEPS["day_2"].state)
+    await schedule_day(user_id, 2)
+    await db.log_event(user_id, "Бот", "Отправил материалы Дня 2")
 
 @router.callback_query(F.data == "day2_done")
 async def intensive_day_3(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.update_interaction(user_id)
+    await db.update_interaction(user_id)
     await callback.answer()
-    db.log_event(user_id, "Интенсив", "Выполнил День 2, перешел ко Дню 3")
-    
-    await state.set_state(SurveyStates.day_3)
+    await db.log_event(user_id, "Интенсив", "Выполнил День 2, перешел ко Дню 3", code="day_3")
     
-    await bot.send_video(chat_id=user_id, video=VIDEO_LESSON_3_ID, caption="Урок 3")
-    
-    text = (
-        "Поздравляю вас, сегодня завершающий день мини интенсива.\n\n"
-        "Урок 3 (видео)\n\n"
-        "Как строятся устойчивые изменения: шаги, которые работают.\n\n"
-        "Сегодня будем учиться переводить себя из позиции \"я опять не справлюсь\" в состояние \"я понимаю как работает процесс изменений\".\n\n"
-        "Узнаем, как мозг реагирует на новое и почему быстро откатывает обратно.\n\n"
-        "Задание: одно действие на сегодня.\n\n"
-        "Выберите одну сферу, где вы давно хотите изменений (тело, отношения, финансы, привычки или самооценка).\n\n"
-        "Запишите одно маленькое действие, которое реально сделать за 5-10 минут и которое немного приблизить вас к цели.\n\n"
-        "Например: выпить стакан воды вместо кофе, написать сообщение, записать расходы, выйти на короткую прогулку, похвалить себя.\n\n"
-        "Вечером отметьте, удалось ли сделать. Если да – замечайте чувство удовлетворения, если нет – мягко проанализируйте, что помешало.\n\n"
-        "Цель: почувствовать, что изменения начинаются не с мотивации, а с маленьких, осознанных действий."
-    )
-    await bot.send_message(chat_id=user_id, text=text)
-
-    prompt = "Нажмите Завершить после того, как выполните задание."
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Завершить интенсив", callback_data="intensive_complete")]
-    ])
-    await bot.send_message(chat_id=user_id, text=prompt, reply_markup=kb)
-    db.log_event(user_id, "Бот", "Отправил материалы Дня 3")
+    await state.set_state(STEPS["day_3"].state)
+    await schedule_day(user_id, 3)
+    await db.log_event(user_id, "Бот", "Отправил материалы Дня 3")
 
 @router.callback_query(F.data == "intensive_complete")
 async def sales_start(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.update_interaction(user_id)
+    await db.update_interaction(user_id)
     await callback.answer()
-    db.log_event(user_id, "Интенсив", "Полностью завершил интенсив")
-    
-    await state.set_state(SurveyStates.sales_main)
-    
-    text = (
-        "Вы сделали первый шаг к решению вашей проблемы. Сейчас я веду набор в групповые программы по 5 направлениям: "
-        "стройность, финансы, самооценка, отношения и зависимости.\n"
-        "Хотите расскажу подробнее о той, которая подходит именно вам?"
-    )
+    await db.log_event(user_id, "Интенсив", "Полностью завершил интенсив", code="intensive_complete")
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Да, хочу в группу", callback_data="sales_group")],
-        [InlineKeyboardButton(text="Хочу работать индивидуально", callback_data="sales_indiv")],
-        [InlineKeyboardButton(text="Есть вопросы", callback_data="sales_questions")]
-    ])
-    
-    with suppress(TelegramBadRequest):
-        await callback.message.edit_text(text, reply_markup=kb)
-    db.log_event(user_id, "Бот", "Предложил платные продукты")
+    await show_step(callback, state, STEPS["sales_main"])
+    await db.log_event(user_id, "Бот", "Предложил платные продукты")
 
 @router.callback_query(F.data == "sales_group")
 async def sales_group_select(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.update_interaction(user_id)
+    await db.update_interaction(user_id)
     await callback.answer()
-    db.log_event(user_id, "Выбор", "Хочет в группу, смотрит направления")
+    await db.log_event(user_id, "Выбор", "Хочет в группу, смотрит направления", code="sales:group")
     
-    await state.set_state(SurveyStates.sales_group_select)
-    text = (
-        "Здорово! У меня есть несколько направлений терапевтических групп:\n"
-        "- Стройность через КПТ-для тех, кто хочет наладить отношения с едой и телом\n"
-        "- Финансовая устойчивость-про деньги и уверенность в себе\n"
-        "- Самооценка и уверенность-чтобы чувствовать больше опоры в себе\n"
-        "- Отношения-про близость, доверие и здоровые границы\n"
-        "- Работа с зависимостями-для тех, кто устал жить \"по кругу\"\n\n"
-        "Выберите какая тема ближе вам сейчас и я расскажу подробнее о ближайшем наборе."
-    )
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Стройность", callback_data="topic_body")],
-        [InlineKeyboardButton(text="Финансы", callback_data="topic_money")],
-        [InlineKeyboardButton(text="Самооценка", callback_data="topic_self")],
-        [InlineKeyboardButton(text="Отношения", callback_data="topic_rel")],
-        [InlineKeyboardButton(text="Негативные привычки", callback_data="topic_habits")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_sales_main")]
-    ])
-    
-    with suppress(TelegramBadRequest):
-        await callback.message.edit_text(text, reply_markup=kb)
+    await show_step(callback, state, STEPS["sales_group"])
 
 @router.callback_query(F.data == "back_to_sales_main")
 async def back_sales_main(callback: types.CallbackQuery, state: FSMContext):
-    db.log_event(callback.from_user.id, "Навигация", "Назад к выбору формата")
+    await db.log_event(callback.from_user.id, "Навигация", "Назад к выбору формата")
     await callback.answer()
     await sales_start(callback, state)
 
 @router.callback_query(F.data.startswith("topic_"))
 async def show_topic_info(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.update_interaction(user_id)
+    await db.update_interaction(user_id)
     await callback.answer()
     
     topic_key = callback.data.split("_")[1]
+    topic_name = TOPICS[topic_key][0] if topic_key in TOPICS else "Общий вопрос"
+    await db.log_event(user_id, "Интерес", f"Выбрал тему: {topic_name}", code=event_code(callback.data) if topic_key in TOPICS else None)
     
-    topic_names = {
-        "body": "Стройность",
-        "money": "Финансы",
-        "self": "Самооценка",
-        "rel": "Отношения",
-        "habits": "Негативные привычки"
-    }
-    
-    topic_name = topic_names.get(topic_key, "Общий вопрос")
-    db.log_event(user_id, "Интерес", f"Выбрал тему: {topic_name}")
-    
-    texts = {
-        "body": (
-            "Эта группа для тех, кто устал от диет, срывов и чувство вины. Мы работаем не с весами, а с привычками, мыслями и эмоциями.\n"
-            "Вы научитесь понимать сигналы тела, справляться с перееданием и строить новые отношения с едой без жёстких ограничений.\n"
-            "Хотите присоединиться к ближайшей группе?"
-        ),
-        "money": (
-            "Финансовые трудности часто связаны не только с цифрами, но и с нашими мыслями, страхами и привычками. "
-            "В группе мы работаем с тревогой о деньгах, откладыванием, с причинами Долгов и с внутренними запретами на доход. "
-            "Это шаг к спокойствию и большой уверенности в завтрашнем дне. Хотите я расскажу о ближайшем наборе?"
-        ),
-        "self": (
-            "Если вы часто сомневаетесь в себе, откладывайте из-за страха ошибки или живёте с внутренним критиком – эта группа поможет.\n"
-            "Вы будете учиться замечать свои сильные стороны, справляться с самокритикой и шага за шагом укреплять уверенность."
-        ),
-        "rel": (
-            "Близкие отношения это источник поддержки, но часто и боли. В группе мы работаем с доверием, умением строить здоровые границы, "
-            "понимать свои чувства и не терять себя в отношениях.\n"
-            "Это пространство, где можно увидеть привычные сценарии и начать строить новые, более здоровые.\n"
-            "Хотите узнать о ближайшей группе?"
-        ),
-        "habits": (
-            "Иногда привычки становится слишком сильными и начинают управлять нами – это могут быть еда, гаджеты, алкоголь или другие формы зависимости. "
-            "В группе мы разбираем как устроены такие механизмы и учимся шаг за шагом возвращать себе контроль. Хотите присоединиться к ближайшей группе?"
-        )
-    }
-    
-    base_text = texts.get(topic_key, "")
-    
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Да, хочу в группу", callback_data="final_yes")],
-        [InlineKeyboardButton(text="Задать вопрос", callback_data="final_q")]
-    ])
-    
-    with suppress(TelegramBadRequest):
-        await callback.message.edit_text(base_text, reply_markup=kb)
+    await show_step(callback, state, TOPIC_STEPS.get(topic_key, STEPS["topic"]))
 
 @router.callback_query(F.data.in_({"final_yes", "final_q"}))
 async def show_final_contact(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.update_interaction(user_id)
+    await db.update_interaction(user_id)
     await callback.answer()
-    db.mark_finished(user_id)
+    await db.mark_finished(user_id)
 
     if callback.data == "final_yes":
-        text = "Если вы чувствуете, что формат группы вам подходит – можно занять место прямо сейчас. Напишите мне и я пришлю все детали: @doctorkashcheeva"
-        db.log_event(user_id, "Финал", "Нажал: Хочу в группу")
+        await db.log_event(user_id, "Финал", "Нажал: Хочу в группу", code="final:yes")
     else:
-        text = "Если у вас есть вопрос, напишите мне: @doctorkashcheeva"
-        db.log_event(user_id, "Финал", "Нажал: Задать вопрос")
+        await db.log_event(user_id, "Финал", "Нажал: Задать вопрос", code="final:q")
 
-    with suppress(TelegramBadRequest):
-        await callback.message.edit_text(text, reply_markup=None)
-    
-    await send_report_to_admins(user_id)
+    await show_step(callback, state, STEPS[callback.data])
+    await send_report_to_admins(user_id, event_code(callback.data))
 
 @router.callback_query(F.data == "sales_indiv")
 async def sales_individual_info(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.update_interaction(user_id)
+    await db.update_interaction(user_id)
     await callback.answer()
-    db.mark_finished(user_id)
-    db.log_event(user_id, "Интерес", "Индивидуальная работа")
+    await db.mark_finished(user_id)
+    await db.log_event(user_id, "Интерес", "Индивидуальная работа", code="sales:indiv")
     
-    text = (
-        "Индивидуальная работа – это безопасное пространство, где все внимание уделяется только вам.\n\n"
-        "На сессиях мы разбираем именно ваш запрос и шаг за шагом идём к изменениям. "
-        "Индивидуальные консультации проходят онлайн и очно (в центре Москвы).\n"
-        "Длительность консультации 50 минут. Рекомендуемая частота – обычно один раз в неделю. "
-        "В среднем от 8 до 20 встреч уже достаточно чтобы почувствовать результат. "
-        "Хотите я помогу подобрать удобное время для первой консультации?\n\n"
-        "Чтобы согласовать удобное время и условия индивидуальной работы с вами, а также уточнить условия – напишите мне:\n"
-        "@doctorkashcheeva"
-    )
-
-    with suppress(TelegramBadRequest):
-        await callback.message.edit_text(text, reply_markup=None)
-    await send_report_to_admins(user_id)
+    await show_step(callback, state, STEPS["sales_indiv"])
+    await send_report_to_admins(user_id, "sales:indiv")
 
 @router.callback_query(F.data == "sales_questions")
 async def sales_questions_info(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    db.update_interaction(user_id)
+    await db.update_interaction(user_id)
     await callback.answer()
-    db.mark_finished(user_id)
-    db.log_event(user_id, "Интерес", "Есть вопросы")
-
-    text = (
-        "Сомневаться и уточнять нормально. Можете просто написать мне, чтобы задать вопрос или обсудить, "
-        "какой формат ближе именно вам:\n"
-        "@doctorkashcheeva"
-    )
-    
-    with suppress(TelegramBadRequest):
-        await callback.message.edit_text(text, reply_markup=None)
-    await send_report_to_admins(user_id)
+    await db.mark_finished(user_id)
+    await db.log_event(user_id, "Интерес", "Есть вопросы", code="sales:questions")
+
+    await show_step(callback, state, STEPS["sales_questions"])
+    await send_report_to_admins(user_id, "sales:questions")
+
+async def wait_for_stop_signal():
+    # SIGTERM (docker stop, systemctl stop) и SIGINT завершают ожидание штатно, чтобы отработали хуки остановки
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+
+async def run_webhook():
+    server = WebhookServer(dp, bot, WEBHOOK_PATH, secret=WEBHOOK_SECRET, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE)
+    await server.start(WEBHOOK_HOST, WEBHOOK_PORT)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=True,
+        )
+    try:
+        await wait_for_stop_signal()
+    finally:
+        await server.stop()
+
+async def run_worker():
+    # Апдейты своей доли пользователей приходят от supervisor.py по локальному HTTP.
+    # По SIGTERM приём прекращается, а уже принятые апдейты дорабатываются
+    server = WebhookServer(dp, bot, WEBHOOK_PATH, secret=WEBHOOK_SECRET, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE)
+    await server.start("127.0.0.1", WORKER_PORT)
+    try:
+        await wait_for_stop_signal()
+    finally:
+        await server.stop()
+
+background_tasks = []
+
+async def start_background():
+    background_tasks.append(asyncio.create_task(reminders.run()))
+    background_tasks.append(asyncio.create_task(delivery.run()))
+    # Общие для всей базы задачи выполняет только один процесс
+    if WORKER_INDEX == 0:
+        if LOG_RETENTION_DAYS:
+            background_tasks.append(asyncio.create_task(retention.run()))
+        if digest is not None:
+            background_tasks.append(asyncio.create_task(digest.run()))
+        await broadcasts.resume()
+
+async def stop_background():
+    # До закрытия базы: иначе задачи упрутся в остановленный поток БД
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await delivery.stop()
 
 async def main():
-    await bot.delete_webhook(drop_pending_updates=True)
-    asyncio.create_task(reminder_scheduler())
-    await dp.start_polling(bot)
+    if bot is None:
+        raise RuntimeError("BOT_TOKEN не задан")
+    polling = WORKER_COUNT == 1 and not WEBHOOK_ENABLED
+    # Сначала база с миграциями, затем независимые проверки параллельно, затем фоновые задачи
+    lifecycle.on_startup({"db": db.open})
+    checks = {"media": media.warmup}
+    if METRICS_PORT:
+        checks["metrics"] = lambda: start_metrics_server(METRICS_HOST, METRICS_PORT + WORKER_INDEX)
+    if polling:
+        checks["delete_webhook"] = lambda: bot.delete_webhook(drop_pending_updates=True)
+    lifecycle.on_startup(checks)
+    lifecycle.on_startup({"background": start_background})
+    # Останавливаются в обратном порядке: фоновые задачи и рассылки, затем FSM-кэш (он пишет через db),
+    # буфер событий и база, последней сессия бота
+    lifecycle.on_shutdown("bot", bot.session.close)
+    lifecycle.on_shutdown("db", db.close)
+    lifecycle.on_shutdown("fsm", storage.close)
+    lifecycle.on_shutdown("broadcasts", broadcasts.stop)
+    lifecycle.on_shutdown("background", stop_background)
+    try:
+        # Внутри try: если упадёт поздний этап старта, хуки остановки всё равно отработают
+        await lifecycle.startup()
+        if WORKER_COUNT > 1:
+            await run_worker()
+        elif WEBHOOK_ENABLED:
+            await run_webhook()
+        else:
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        await lifecycle.shutdown()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
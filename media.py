@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import os
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, InputMediaVideo
+
+from config import VIDEO_WELCOME_ID, VIDEO_LESSON_1_ID, VIDEO_LESSON_2_ID, VIDEO_LESSON_3_ID
+
+# Ключ -> (file_id из окружения, подпись); локальный запасной файл: MEDIA_DIR/<ключ>.mp4
+VIDEOS = {
+    "welcome": (VIDEO_WELCOME_ID, "Приветствие"),
+    "lesson_1": (VIDEO_LESSON_1_ID, "Урок 1"),
+    "lesson_2": (VIDEO_LESSON_2_ID, "Урок 2"),
+    "lesson_3": (VIDEO_LESSON_3_ID, "Урок 3"),
+}
+
+
+class MediaRegistry:
+    # file_id проверяются один раз при старте; если и значение из окружения, и сохранённое ранее протухли,
+    # видео загружается из локального файла, а новый file_id сохраняется в media_files
+    def __init__(self, bot, db, media_dir, upload_chat_id):
+        self.bot = bot
+        self.db = db
+        self.media_dir = media_dir
+        self.upload_chat_id = upload_chat_id
+        self.file_ids = {key: file_id for key, (file_id, _) in VIDEOS.items()}
+        self.items = {}
+        self._build()
+
+    def _build(self):
+        self.items = {
+            key: InputMediaVideo(media=self.file_ids[key], caption=caption)
+            for key, (_, caption) in VIDEOS.items()
+            if self.file_ids[key]
+        }
+
+    def video(self, key):
+        return {"video": self.file_ids[key], "caption": VIDEOS[key][1]}
+
+    def group(self, keys):
+        return [self.items[key] for key in keys]
+
+    async def _is_valid(self, file_id):
+        if not file_id:
+            return False
+        try:
+            await self.bot.get_file(file_id)
+        except TelegramBadRequest as e:
+            # getFile не отдаёт файлы больше 20 МБ, но сам file_id при этом рабочий
+            return "too big" in str(e).lower()
+        except Exception as e:
+            # Сеть или другая ошибка API: проверить не удалось, это не значит, что file_id протух — оставляем его
+            logging.warning("Не удалось проверить file_id %s: %s", file_id, e)
+            return True
+        return True
+
+    async def _upload(self, key):
+        path = os.path.join(self.media_dir, f"{key}.mp4")
+        if not os.path.exists(path):
+            return None
+        message = await self.bot.send_video(chat_id=self.upload_chat_id, video=FSInputFile(path), caption=VIDEOS[key][1])
+        try:
+            await self.bot.delete_message(chat_id=self.upload_chat_id, message_id=message.message_id)
+        except TelegramBadRequest:
+            pass
+        return message.video.file_id
+
+    async def _resolve(self, key, stored_file_id):
+        env_file_id = VIDEOS[key][0]
+        for candidate in dict.fromkeys(file_id for file_id in (env_file_id, stored_file_id) if file_id):
+            if await self._is_valid(candidate):
+                return candidate
+        try:
+            file_id = await self._upload(key)
+        except Exception:
+            logging.exception("Не удалось загрузить видео %s из %s", key, self.media_dir)
+            file_id = None
+        if file_id is None:
+            logging.error("Видео %s недоступно: file_id не прошёл проверку и нет файла в %s", key, self.media_dir)
+            return env_file_id
+        logging.info("Видео %s загружено заново", key)
+        try:
+            await self.db.save_media_file(key, file_id)
+        except Exception:
+            logging.exception("Не удалось сохранить file_id видео %s", key)
+        return file_id
+
+    async def warmup(self):
+        # Видео независимы, поэтому проверяются параллельно: старт ждёт самый медленный getFile, а не их сумму
+        # Проверка видео не должна мешать старту бота: при любых ошибках остаются текущие file_id
+        try:
+            stored = await self.db.get_media_files()
+        except Exception:
+            logging.exception("Не удалось прочитать сохранённые file_id видео")
+            stored = {}
+        file_ids = await asyncio.gather(*(self._resolve(key, stored.get(key)) for key in VIDEOS))
+        self.file_ids.update(zip(VIDEOS, file_ids))
+        self._build()
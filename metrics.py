@@ -0,0 +1,175 @@
+import bisect
+import re
+import time
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Histogram:
+    # Без внешних зависимостей: на одно наблюдение один bisect и пара операций со словарём
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, max_series=1000):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.max_series = max_series
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            # callback_data присылает клиент, поэтому число серий ограничено
+            if len(self.series) >= self.max_series:
+                labels = ("other",) * len(self.labelnames)
+                series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames + ('le',), labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(self.labels, time.perf_counter() - self.started)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    # Значение считается в момент запроса /metrics: функция возвращает число или {значение метки: число}
+    def __init__(self, name, documentation, func, labelname=None):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.labelname = labelname
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        value = self.func()
+        if isinstance(value, dict):
+            for label, item in value.items():
+                lines.append(f"{self.name}{_format_labels((self.labelname,), (label,))} {item}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, func, labelname=None):
+        metric = Gauge(name, documentation, func, labelname)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+HANDLER_LATENCY = REGISTRY.histogram("bot_handler_seconds", "Время обработки апдейта хендлером", ("handler", "data"))
+HANDLER_ERRORS = REGISTRY.counter("bot_handler_errors_total", "Исключения в хендлерах", ("handler",))
+DB_LATENCY = REGISTRY.histogram("bot_db_call_seconds", "Время вызова Database, включая ожидание потока БД", ("method",))
+API_LATENCY = REGISTRY.histogram("bot_api_call_seconds", "Время запросов к Bot API", ("method",))
+OUTBOUND_WAIT = REGISTRY.histogram("bot_outbound_wait_seconds", "Ожидание в очереди исходящих сообщений", ("lane",))
+
+_DYNAMIC_SUFFIX = re.compile(r"_\d.*$")
+
+
+def callback_label(data):
+    # adm_page_12_n_... и подобные значения сворачиваются в префикс, чтобы не плодить серии
+    if not data:
+        return ""
+    return _DYNAMIC_SUFFIX.sub("", data)[:32]
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object is not None else "unknown"
+        label = callback_label(getattr(event, "data", None))
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc((name,))
+            raise
+        finally:
+            HANDLER_LATENCY.observe((name, label), time.perf_counter() - started)
+
+
+async def start_metrics_server(host, port):
+    async def handle(request):
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
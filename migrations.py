@@ -0,0 +1,384 @@
+import datetime
+
+# Миграции применяются по порядку при старте; уже применённые версии хранятся в schema_version.
+# Новые шаги только добавляются в конец списка, старые не редактируются.
+MIGRATIONS = [
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            joined_at TEXT,
+            last_interaction TEXT,
+            is_finished BOOLEAN DEFAULT 0,
+            reminded BOOLEAN DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            event_type TEXT,
+            content TEXT,
+            timestamp TEXT
+        )
+        """,
+    ]),
+    (2, [
+        "CREATE INDEX IF NOT EXISTS idx_logs_user_timestamp ON logs (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_users_joined_at ON users (joined_at)",
+        """
+        CREATE INDEX IF NOT EXISTS idx_users_reminder ON users (last_interaction)
+        WHERE is_finished = 0 AND reminded = 0
+        """,
+    ]),
+    (3, [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at TEXT
+        )
+        """,
+    ]),
+    (4, [
+        "ALTER TABLE users ADD COLUMN is_blocked BOOLEAN DEFAULT 0",
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            text TEXT,
+            status TEXT,
+            cursor INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            progress_chat_id INTEGER,
+            progress_message_id INTEGER,
+            created_at TEXT,
+            finished_at TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER,
+            user_id INTEGER,
+            status TEXT,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+        """,
+    ]),
+]
+
+
+# Коды для строк logs, записанных до появления колонки code: (код, event_type, content)
+LEGACY_EVENT_CODES = [
+    ("start", "Пользователь", "Запустил бота /start"),
+    ("start_flow", "Действие", "Нажал кнопку 'Пройти опрос'"),
+    ("q1:food", "Выбор сферы", "Еда и тело"),
+    ("q1:money", "Выбор сферы", "Деньги"),
+    ("q1:confidence", "Выбор сферы", "Уверенность"),
+    ("q1:relations", "Выбор сферы", "Отношения"),
+    ("q1:habits", "Выбор сферы", "Привычки"),
+    ("q2:inside", "Выбор поддержки", "Держу в себе"),
+    ("q2:friends", "Выбор поддержки", "С близкими"),
+    ("q2:pro", "Выбор поддержки", "К специалисту"),
+    ("q3:now", "Отношение к группе", "Хочу сейчас"),
+    ("q3:think", "Отношение к группе", "Думаю"),
+    ("q3:unsure", "Отношение к группе", "Нет уверенности"),
+    ("day_1", "Интенсив", "Начал День 1"),
+    ("day_2", "Интенсив", "Выполнил День 1, перешел ко Дню 2"),
+    ("day_3", "Интенсив", "Выполнил День 2, перешел ко Дню 3"),
+    ("intensive_complete", "Интенсив", "Полностью завершил интенсив"),
+    ("sales:group", "Выбор", "Хочет в группу, смотрит направления"),
+    ("sales:indiv", "Интерес", "Индивидуальная работа"),
+    ("sales:questions", "Интерес", "Есть вопросы"),
+    ("topic:body", "Интерес", "Выбрал тему: Стройность"),
+    ("topic:money", "Интерес", "Выбрал тему: Финансы"),
+    ("topic:self", "Интерес", "Выбрал тему: Самооценка"),
+    ("topic:rel", "Интерес", "Выбрал тему: Отношения"),
+    ("topic:habits", "Интерес", "Выбрал тему: Негативные привычки"),
+    ("final:yes", "Финал", "Нажал: Хочу в группу"),
+    ("final:q", "Финал", "Нажал: Задать вопрос"),
+]
+
+
+def _literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _backfill_event_codes():
+    statements = [
+        f"UPDATE logs SET code = {_literal(code)} WHERE code IS NULL AND event_type = {_literal(event_type)} AND content = {_literal(content)}"
+        for code, event_type, content in LEGACY_EVENT_CODES
+    ]
+    statements += [
+        """
+        INSERT OR IGNORE INTO funnel_user_steps (user_id, code, first_at)
+        SELECT user_id, code, MIN(timestamp) FROM logs WHERE code IS NOT NULL GROUP BY user_id, code
+        """,
+        """
+        INSERT OR IGNORE INTO funnel_user_steps (user_id, code, first_at)
+        SELECT user_id, substr(code, 1, instr(code, ':') - 1), MIN(timestamp) FROM logs
+        WHERE instr(code, ':') > 0 GROUP BY user_id, substr(code, 1, instr(code, ':') - 1)
+        """,
+        """
+        INSERT INTO funnel_daily (day, code, events)
+        SELECT substr(timestamp, 1, 10), code, COUNT(*) FROM logs WHERE code IS NOT NULL
+        GROUP BY substr(timestamp, 1, 10), code
+        ON CONFLICT(day, code) DO UPDATE SET events = events + excluded.events
+        """,
+        """
+        INSERT INTO funnel_totals (code, events)
+        SELECT code, COUNT(*) FROM logs WHERE code IS NOT NULL GROUP BY code
+        ON CONFLICT(code) DO UPDATE SET events = events + excluded.events
+        """,
+    ]
+    return statements
+
+
+MIGRATIONS.append((5, [
+    "ALTER TABLE logs ADD COLUMN code TEXT",
+    """
+    CREATE TABLE IF NOT EXISTS funnel_user_steps (
+        user_id INTEGER,
+        code TEXT,
+        first_at TEXT,
+        PRIMARY KEY (user_id, code)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS funnel_daily (
+        day TEXT,
+        code TEXT,
+        events INTEGER DEFAULT 0,
+        users INTEGER DEFAULT 0,
+        PRIMARY KEY (day, code)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS funnel_totals (
+        code TEXT PRIMARY KEY,
+        events INTEGER DEFAULT 0,
+        users INTEGER DEFAULT 0
+    ) WITHOUT ROWID
+    """,
+    # Роллапы поддерживаются триггерами, поэтому работают и для пакетной записи через executemany
+    """
+    CREATE TRIGGER IF NOT EXISTS logs_funnel_rollup AFTER INSERT ON logs
+    WHEN NEW.code IS NOT NULL
+    BEGIN
+        INSERT INTO funnel_daily (day, code, events) VALUES (substr(NEW.timestamp, 1, 10), NEW.code, 1)
+            ON CONFLICT(day, code) DO UPDATE SET events = events + 1;
+        INSERT INTO funnel_totals (code, events) VALUES (NEW.code, 1)
+            ON CONFLICT(code) DO UPDATE SET events = events + 1;
+        INSERT OR IGNORE INTO funnel_user_steps (user_id, code, first_at) VALUES (NEW.user_id, NEW.code, NEW.timestamp);
+        INSERT OR IGNORE INTO funnel_user_steps (user_id, code, first_at)
+            SELECT NEW.user_id, substr(NEW.code, 1, instr(NEW.code, ':') - 1), NEW.timestamp
+            WHERE instr(NEW.code, ':') > 0;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS funnel_user_steps_rollup AFTER INSERT ON funnel_user_steps
+    BEGIN
+        INSERT INTO funnel_daily (day, code, users) VALUES (substr(NEW.first_at, 1, 10), NEW.code, 1)
+            ON CONFLICT(day, code) DO UPDATE SET users = users + 1;
+        INSERT INTO funnel_totals (code, users) VALUES (NEW.code, 1)
+            ON CONFLICT(code) DO UPDATE SET users = users + 1;
+    END
+    """,
+] + _backfill_event_codes()))
+
+MIGRATIONS.append((6, [
+    # Какие месяцы архива содержат строки пользователя: читаем только нужные файлы
+    """
+    CREATE TABLE IF NOT EXISTS log_archive_index (
+        user_id INTEGER,
+        month TEXT,
+        rows INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, month)
+    ) WITHOUT ROWID
+    """,
+]))
+
+MIGRATIONS.append((7, [
+    """
+    CREATE TABLE IF NOT EXISTS scheduled_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        due_at TEXT,
+        method TEXT,
+        payload TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_scheduled_messages_due ON scheduled_messages (due_at, id)",
+]))
+
+MIGRATIONS.append((8, [
+    """
+    CREATE TABLE IF NOT EXISTS media_files (
+        key TEXT PRIMARY KEY,
+        file_id TEXT,
+        updated_at TEXT
+    )
+    """,
+]))
+
+MIGRATIONS.append((9, [
+    # Полнотекстовый поиск для /find. Индексы внешние (content=...): тексты хранятся только в users и logs,
+    # FTS держит лишь токены; синхронизацию ведут триггеры
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+        username, first_name,
+        content='users', content_rowid='user_id', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS logs_fts USING fts5(
+        content, code,
+        content='logs', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users
+    BEGIN
+        INSERT INTO users_fts (rowid, username, first_name) VALUES (NEW.user_id, NEW.username, NEW.first_name);
+    END
+    """,
+    # last_interaction и флаги меняются постоянно, индекс трогаем только при смене ника или имени
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username, first_name ON users
+    WHEN OLD.username IS NOT NEW.username OR OLD.first_name IS NOT NEW.first_name
+    BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username, first_name) VALUES ('delete', OLD.user_id, OLD.username, OLD.first_name);
+        INSERT INTO users_fts (rowid, username, first_name) VALUES (NEW.user_id, NEW.username, NEW.first_name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users
+    BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username, first_name) VALUES ('delete', OLD.user_id, OLD.username, OLD.first_name);
+    END
+    """,
+    # Логи только дописываются и удаляются при архивации. Свои реплики бота ('Бот') — одинаковые шаблоны
+    # без сведений о пользователе, в индекс они не попадают; условие на удаление обязано совпадать с условием вставки
+    """
+    CREATE TRIGGER IF NOT EXISTS logs_fts_insert AFTER INSERT ON logs
+    WHEN NEW.event_type IS NOT 'Бот'
+    BEGIN
+        INSERT INTO logs_fts (rowid, content, code) VALUES (NEW.id, NEW.content, NEW.code);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS logs_fts_delete AFTER DELETE ON logs
+    WHEN OLD.event_type IS NOT 'Бот'
+    BEGIN
+        INSERT INTO logs_fts (logs_fts, rowid, content, code) VALUES ('delete', OLD.id, OLD.content, OLD.code);
+    END
+    """,
+    "INSERT INTO users_fts (users_fts) VALUES ('rebuild')",
+    # 'rebuild' проиндексировал бы и реплики бота, поэтому логи заливаем тем же фильтром, что и в триггере
+    "INSERT INTO logs_fts (rowid, content, code) SELECT id, content, code FROM logs WHERE event_type IS NOT 'Бот'",
+]))
+
+
+def _summary_upsert(row, source):
+    # Свёртка одного события в снимок пользователя: ответы перезаписываются последним выбором,
+    # день интенсива только растёт, даты завершения фиксируются по первому событию
+    def variant(step):
+        return f"CASE WHEN substr({row}.code, 1, {len(step) + 1}) = '{step}:' THEN substr({row}.code, {len(step) + 2}) END"
+
+    return f"""
+    INSERT INTO user_summary (user_id, q1, q2, q3, day, topic, sales, final, started_at, intensive_done_at, finished_at, updated_at)
+    SELECT {row}.user_id, {variant('q1')}, {variant('q2')}, {variant('q3')},
+        CASE WHEN {row}.code IN ('day_1', 'day_2', 'day_3') THEN CAST(substr({row}.code, 5) AS INTEGER) ELSE 0 END,
+        {variant('topic')}, {variant('sales')}, {variant('final')}, {row}.timestamp,
+        CASE WHEN {row}.code = 'intensive_complete' THEN {row}.timestamp END,
+        CASE WHEN {row}.code IN ('sales:indiv', 'sales:questions', 'final:yes', 'final:q') THEN {row}.timestamp END,
+        {row}.timestamp
+    {source}
+    ON CONFLICT(user_id) DO UPDATE SET
+        q1 = COALESCE(excluded.q1, q1), q2 = COALESCE(excluded.q2, q2), q3 = COALESCE(excluded.q3, q3),
+        day = MAX(day, excluded.day),
+        topic = COALESCE(excluded.topic, topic), sales = COALESCE(excluded.sales, sales), final = COALESCE(excluded.final, final),
+        intensive_done_at = COALESCE(intensive_done_at, excluded.intensive_done_at),
+        finished_at = COALESCE(finished_at, excluded.finished_at),
+        updated_at = excluded.updated_at
+    """
+
+
+MIGRATIONS.append((10, [
+    # Снимок воронки по пользователю для отчёта админам: одна строка вместо чтения всей истории логов
+    """
+    CREATE TABLE IF NOT EXISTS user_summary (
+        user_id INTEGER PRIMARY KEY,
+        q1 TEXT,
+        q2 TEXT,
+        q3 TEXT,
+        day INTEGER DEFAULT 0,
+        topic TEXT,
+        sales TEXT,
+        final TEXT,
+        started_at TEXT,
+        intensive_done_at TEXT,
+        finished_at TEXT,
+        updated_at TEXT
+    )
+    """,
+    # Когда по пользователю последний раз уходил отчёт с данным финальным событием: повторы в окне не отправляются
+    """
+    CREATE TABLE IF NOT EXISTS user_reports (
+        user_id INTEGER,
+        code TEXT,
+        reported_at TEXT,
+        PRIMARY KEY (user_id, code)
+    ) WITHOUT ROWID
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS logs_user_summary AFTER INSERT ON logs
+    WHEN NEW.code IS NOT NULL
+    BEGIN
+        {_summary_upsert("NEW", "WHERE true")};
+    END
+    """,
+    # Для существующих пользователей снимок собирается из логов в порядке записи
+    _summary_upsert("logs", "FROM logs WHERE logs.code IS NOT NULL ORDER BY logs.id"),
+]))
+
+MIGRATIONS.append((11, [
+    # Отчёты, ещё не ушедшие в дайджест админам; частичный индекс держит только очередь
+    "ALTER TABLE user_reports ADD COLUMN pending INTEGER DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS idx_user_reports_pending ON user_reports (reported_at) WHERE pending = 1",
+]))
+
+
+def get_schema_version(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at TEXT
+        )
+    """)
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def apply_migrations(conn, target=None):
+    current = get_schema_version(conn)
+    for version, statements in MIGRATIONS:
+        if version <= current or (target is not None and version > target):
+            continue
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            conn.execute("BEGIN")
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)", (version, now))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return get_schema_version(conn)
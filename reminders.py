@@ -0,0 +1,123 @@
+import asyncio
+import datetime
+import heapq
+import logging
+
+from sender import PRIORITY_BULK
+
+REMINDER_TEXT = (
+    "Здравствуйте! Я заметила, что вы не завершили наш диалог. "
+    "Хотите продолжить путь к изменениям? Нажмите на последнюю кнопку или напишите /start, чтобы начать заново."
+)
+
+
+class ReminderScheduler:
+    # Куча дедлайнов (время напоминания, user_id): спим до ближайшего, а не опрашиваем БД по таймеру.
+    # Устаревшие записи в куче не удаляются сразу, а отбрасываются при извлечении по словарю due.
+    def __init__(self, bot, db, outbound, delay=datetime.timedelta(days=1), batch_size=20, batch_interval=1.0, owns=None):
+        self.bot = bot
+        self.owns = owns
+        self.db = db
+        self.outbound = outbound
+        self.delay = delay
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.heap = []
+        self.due = {}
+        self.wakeup = asyncio.Event()
+
+    def schedule(self, user_id, last_interaction):
+        due = last_interaction + self.delay
+        self.due[user_id] = due
+        heapq.heappush(self.heap, (due, user_id))
+        if self.heap[0][1] == user_id:
+            self.wakeup.set()
+        if len(self.heap) > 2 * len(self.due) + 1000:
+            self.heap = [(due, user_id) for user_id, due in self.due.items()]
+            heapq.heapify(self.heap)
+
+    def touch(self, user_id):
+        self.schedule(user_id, datetime.datetime.now())
+
+    def cancel(self, user_id):
+        self.due.pop(user_id, None)
+
+    def __len__(self):
+        return len(self.due)
+
+    async def load(self):
+        for user_id, last_interaction in await self.db.get_reminder_candidates():
+            if self.owns is not None and not self.owns(user_id):
+                continue
+            self.schedule(user_id, parse_time(last_interaction))
+
+    def _pop_due(self, now):
+        batch = []
+        while self.heap and self.heap[0][0] <= now and len(batch) < self.batch_size:
+            due, user_id = heapq.heappop(self.heap)
+            if self.due.get(user_id) == due:
+                del self.due[user_id]
+                batch.append(user_id)
+        return batch
+
+    async def _wait(self, timeout):
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        while True:
+            try:
+                await self.load()
+                break
+            except Exception:
+                logging.exception("Не удалось загрузить расписание напоминаний, повтор")
+                await asyncio.sleep(5)
+        while True:
+            while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                await self._wait(None)
+                continue
+
+            now = datetime.datetime.now()
+            timeout = (self.heap[0][0] - now).total_seconds()
+            if timeout > 0:
+                await self._wait(timeout)
+                continue
+
+            try:
+                await self._send_batch(self._pop_due(now))
+            except Exception:
+                pass
+            await asyncio.sleep(self.batch_interval)
+
+    async def _send_batch(self, user_ids):
+        # БД остаётся источником истины: пользователь мог завершить воронку или взаимодействовать в обход touch
+        now = datetime.datetime.now()
+        to_remind = []
+        for user_id, last_interaction in await self.db.get_reminder_candidates(user_ids):
+            last = parse_time(last_interaction)
+            if last + self.delay <= now:
+                to_remind.append(user_id)
+            else:
+                self.schedule(user_id, last)
+        if not to_remind:
+            return
+
+        await asyncio.gather(*(self._send(user_id) for user_id in to_remind))
+        await self.db.set_reminded_many(to_remind)
+
+    async def _send(self, user_id):
+        try:
+            await self.outbound.send(self.bot.send_message, priority=PRIORITY_BULK, chat_id=user_id, text=REMINDER_TEXT)
+        except Exception:
+            pass
+
+
+def parse_time(value):
+    if not value:
+        return datetime.datetime.min
+    return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import datetime
+import logging
+
+
+class LogRetention:
+    # Горячая таблица logs держит только последние days дней, остальное уезжает в помесячный архив.
+    # Работа идёт порциями через поток БД, чтобы между ними успевали проходить обычные записи
+    def __init__(self, db, days, interval, chunk_size=5000, vacuum_pages=1000):
+        self.db = db
+        self.days = days
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.vacuum_pages = vacuum_pages
+        self.archived = 0
+
+    async def run_once(self):
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=self.days)).strftime("%Y-%m-%d %H:%M:%S")
+        total = 0
+        while True:
+            archived = await self.db.archive_logs(cutoff, self.chunk_size)
+            total += archived
+            if archived < self.chunk_size:
+                break
+        if total:
+            while await self.db.compact(self.vacuum_pages):
+                await asyncio.sleep(0)
+            self.archived += total
+            logging.info("Архивировано строк логов: %s (старше %s)", total, cutoff)
+        return total
+
+    async def run(self):
+        try:
+            if not await self.db.is_incremental_vacuum():
+                logging.warning(
+                    "База не в режиме auto_vacuum=INCREMENTAL: место после архивации не освобождается. "
+                    "Остановите бота и выполните python retention.py --vacuum"
+                )
+        except Exception:
+            logging.exception("Не удалось проверить режим auto_vacuum")
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logging.exception("Ошибка архивации логов")
+            await asyncio.sleep(self.interval)
+
+
+def main():
+    # Разовые шаги обслуживания; выполняются при остановленном боте, потому что держат базу целиком
+    parser = argparse.ArgumentParser(description="Обслуживание базы: архивация логов и перевод на incremental vacuum")
+    parser.add_argument("--vacuum", action="store_true", help="Перевести базу в auto_vacuum=INCREMENTAL (полный VACUUM)")
+    parser.add_argument("--archive", action="store_true", help="Один проход архивации логов старше LOG_RETENTION_DAYS")
+    args = parser.parse_args()
+
+    from config import LOG_RETENTION_DAYS, LOG_RETENTION_INTERVAL
+    from database import db
+
+    async def run():
+        if args.vacuum:
+            changed = await db.enable_incremental_vacuum()
+            logging.info("База переведена в режим auto_vacuum=INCREMENTAL" if changed else "База уже в режиме auto_vacuum=INCREMENTAL")
+        if args.archive and LOG_RETENTION_DAYS:
+            await LogRetention(db, LOG_RETENTION_DAYS, LOG_RETENTION_INTERVAL).run_once()
+        await db.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    main()
@@ -0,0 +1,208 @@
+import asyncio
+import collections
+import contextvars
+import logging
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from metrics import API_LATENCY, OUTBOUND_WAIT
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_REPORT = 1
+PRIORITY_BULK = 2
+LANE_NAMES = ("interactive", "report", "bulk")
+# Методы API, которые Telegram ограничивает по частоте и которые поэтому идут через очередь
+LIMITED_METHODS = ("send", "edit", "copy", "forward")
+# Запрос выполняется самой очередью: повторно в неё не ставится
+IN_QUEUE = contextvars.ContextVar("in_outbound_queue", default=False)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        self.paused_until = max(self.paused_until, now + seconds)
+
+
+class OutboundQueue:
+    # Единая точка исходящих send_*: общий лимит Telegram (~30 msg/s), лимит на чат и приоритетные полосы.
+    # Интерактивные ответы всегда забирают токен раньше напоминаний, отчётов и рассылок.
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, scan_limit=100, max_retries=5):
+        # Запас не меньше одного токена, иначе при доле лимита < 1 msg/s отправка встанет навсегда
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.lanes = [collections.deque() for _ in (PRIORITY_INTERACTIVE, PRIORITY_REPORT, PRIORITY_BULK)]
+        self.scan_limit = scan_limit
+        self.max_retries = max_retries
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.executing = set()
+        self.stats = collections.Counter()
+        self.wait_time = [0.0 for _ in self.lanes]
+
+    def _ensure_started(self):
+        # Цикл поднимается заново, если задача по какой-то причине завершилась: иначе send() ждал бы вечно
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+            self.task.add_done_callback(self._on_stopped)
+
+    def _on_stopped(self, task):
+        if task.cancelled():
+            return
+        logging.error("Цикл очереди отправки остановился", exc_info=task.exception())
+        if any(self.lanes):
+            # Уже поставленные сообщения не должны ждать следующего send(); пауза — чтобы не крутиться на повторяющейся ошибке
+            asyncio.get_running_loop().call_later(1.0, self._ensure_started)
+
+    async def send(self, method, priority=PRIORITY_INTERACTIVE, **kwargs):
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self.lanes[priority].append([method, kwargs, future, time.monotonic(), 0])
+        self.stats["queued"] += 1
+        self.wakeup.set()
+        return await future
+
+    def drop(self, priority, predicate):
+        # Снимает из полосы ещё не отправленные сообщения; их отправители получают CancelledError.
+        # Уже ушедшие в API запросы не трогаем: их результат придёт как обычно
+        kept = collections.deque()
+        for item in self.lanes[priority]:
+            if predicate(item[1]):
+                item[2].cancel()
+            else:
+                kept.append(item)
+        self.lanes[priority] = kept
+
+    def queue_depth(self):
+        return [len(lane) for lane in self.lanes]
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                self._prune_chat_buckets()
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _prune_chat_buckets(self):
+        now = time.monotonic()
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if bucket.delay(now) == 0 and bucket.tokens >= bucket.capacity:
+                del self.chat_buckets[chat_id]
+
+    def _pick(self, now):
+        min_wait = None
+        for priority, lane in enumerate(self.lanes):
+            for index, item in enumerate(lane):
+                if index >= self.scan_limit:
+                    break
+                wait = self._chat_bucket(item[1]["chat_id"]).delay(now)
+                if wait <= 0:
+                    del lane[index]
+                    return priority, item, 0.0
+                min_wait = wait if min_wait is None else min(min_wait, wait)
+        return None, None, min_wait
+
+    async def _sleep(self, timeout):
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        while True:
+            if not any(self.lanes):
+                await self._sleep(None)
+                continue
+
+            now = time.monotonic()
+            global_wait = self.global_bucket.delay(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                continue
+
+            priority, item, min_wait = self._pick(now)
+            if item is None:
+                await self._sleep(min_wait)
+                continue
+            if item[2].done():
+                # Отправитель уже отказался от сообщения (задача отменена), токены на него не тратим
+                continue
+
+            self.global_bucket.consume(now)
+            self._chat_bucket(item[1]["chat_id"]).consume(now)
+            self.wait_time[priority] += now - item[3]
+            OUTBOUND_WAIT.observe((LANE_NAMES[priority],), now - item[3])
+            task = asyncio.create_task(self._execute(priority, item))
+            self.executing.add(task)
+            task.add_done_callback(self.executing.discard)
+
+    async def _execute(self, priority, item):
+        method, kwargs, future, _, attempts = item
+        IN_QUEUE.set(True)
+        try:
+            with API_LATENCY.time(getattr(method, "__name__", "unknown")):
+                result = await method(**kwargs)
+        except TelegramRetryAfter as e:
+            self.stats["retry_after"] += 1
+            now = time.monotonic()
+            self._chat_bucket(kwargs["chat_id"]).pause(now, e.retry_after)
+            self.global_bucket.pause(now, e.retry_after)
+            if attempts + 1 >= self.max_retries:
+                self.stats["failed"] += 1
+                if not future.done():
+                    future.set_exception(e)
+                return
+            item[4] = attempts + 1
+            self.lanes[priority].appendleft(item)
+            self.wakeup.set()
+            return
+        except Exception as e:
+            self.stats["failed"] += 1
+            if not future.done():
+                future.set_exception(e)
+            return
+        self.stats["sent"] += 1
+        if not future.done():
+            future.set_result(result)
+
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    # Прямые вызовы из хендлеров (message.answer, edit_text, answer_video...) тоже проходят через OutboundQueue
+    # в интерактивной полосе: общий лимит 30 msg/s делится с рассылками, а приоритет защищает ответы пользователям
+    def __init__(self, outbound):
+        self.outbound = outbound
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if IN_QUEUE.get() or chat_id is None or not method.__api_method__.startswith(LIMITED_METHODS):
+            return await make_request(bot, method)
+
+        async def request(chat_id):
+            return await make_request(bot, method)
+
+        request.__name__ = method.__api_method__
+        return await self.outbound.send(request, priority=PRIORITY_INTERACTIVE, chat_id=chat_id)
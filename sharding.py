@@ -0,0 +1,24 @@
+from config import ADMIN_IDS
+
+# Типы апдейтов, которые бот обрабатывает; в режиме супервизора их запрашивает он, а не воркеры
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member"]
+
+
+def shard_of(user_id, count):
+    # Админы всегда на воркере 0: там же возобновляются рассылки, поэтому /broadcast_stop попадает куда нужно
+    if count <= 1 or user_id is None or user_id in ADMIN_IDS:
+        return 0
+    return user_id % count
+
+
+def update_user_id(update):
+    # Апдейт о подписке на канал маршрутизируется по подписчику, а не по автору изменения:
+    # кэш подписок живёт в процессе того воркера, который ведёт этого пользователя
+    member = update.get("chat_member")
+    if member is not None:
+        return member.get("new_chat_member", {}).get("user", {}).get("id")
+    for key in ("message", "edited_message", "callback_query", "my_chat_member"):
+        event = update.get(key)
+        if event is not None:
+            return event.get("from", {}).get("id")
+    return None
@@ -0,0 +1,61 @@
+import asyncio
+import collections
+import time
+
+from metrics import API_LATENCY
+
+SUBSCRIBED_STATUSES = {"member", "administrator", "creator"}
+
+
+class SubscriptionCache:
+    # Кэш статуса подписки на канал: отдельные TTL для «подписан» и «не подписан»,
+    # один запрос get_chat_member на пользователя, даже если проверок одновременно несколько.
+    # Размер ограничен (LRU): давно не проверявшиеся пользователи вытесняются
+    def __init__(self, bot, channel_id, positive_ttl=3600, negative_ttl=60, max_size=10000):
+        self.bot = bot
+        self.channel_id = channel_id
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def set_status(self, user_id, status):
+        subscribed = status in SUBSCRIBED_STATUSES
+        ttl = self.positive_ttl if subscribed else self.negative_ttl
+        self.entries[user_id] = (subscribed, time.monotonic() + ttl)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return subscribed
+
+    def invalidate(self, user_id):
+        self.entries.pop(user_id, None)
+
+    def is_channel(self, chat):
+        channel_id = str(self.channel_id)
+        if channel_id.startswith("@"):
+            return chat.username is not None and chat.username.lower() == channel_id[1:].lower()
+        return str(chat.id) == channel_id
+
+    async def is_subscribed(self, user_id, refresh_negative=False):
+        entry = self.entries.get(user_id)
+        if entry is not None and entry[1] > time.monotonic() and (entry[0] or not refresh_negative):
+            self.hits += 1
+            self.entries.move_to_end(user_id)
+            return entry[0]
+        self.misses += 1
+
+        task = self.inflight.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(user_id))
+            self.inflight[user_id] = task
+            task.add_done_callback(lambda _: self.inflight.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, user_id):
+        with API_LATENCY.time("get_chat_member"):
+            member = await self.bot.get_chat_member(chat_id=self.channel_id, user_id=user_id)
+        return self.set_status(user_id, member.status)
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+import signal
+import sqlite3
+import sys
+
+import aiohttp
+from aiohttp import web
+
+from config import BOT_TOKEN, TELEGRAM_API_URL, WEBHOOK_ENABLED, WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET
+from config import WORKERS, WORKER_BASE_PORT, WEBHOOK_QUEUE_SIZE
+from migrations import apply_migrations
+from sharding import ALLOWED_UPDATES, shard_of, update_user_id
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class Worker:
+    # Процесс main.py в режиме воркера и очередь апдейтов к нему. Пересылка идёт одним потоком,
+    # поэтому апдейты пользователя приходят в воркер в том же порядке, что и в супервизор
+    def __init__(self, index, count, port):
+        self.index = index
+        self.count = count
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}{WEBHOOK_PATH}"
+        self.queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        self.process = None
+        self.running = asyncio.Event()
+        self.stopping = False
+
+    async def spawn(self):
+        env = dict(os.environ, WORKER_INDEX=str(self.index), WORKER_COUNT=str(self.count), WORKER_PORT=str(self.port))
+        self.process = await asyncio.create_subprocess_exec(sys.executable, MAIN, env=env)
+        self.running.set()
+        logging.info("Воркер %s запущен, pid %s", self.index, self.process.pid)
+
+    async def terminate(self, timeout=60):
+        # Воркер по SIGTERM перестаёт принимать апдейты и дорабатывает свою очередь
+        self.running.clear()
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Воркер %s не завершился за %s с, останавливаю принудительно", self.index, timeout)
+            self.process.kill()
+            await self.process.wait()
+
+    async def wait_ready(self, timeout=120):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while asyncio.get_running_loop().time() < deadline:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", self.port)
+            except OSError:
+                await asyncio.sleep(0.2)
+                continue
+            writer.close()
+            return True
+        return False
+
+    async def restart(self):
+        await self.terminate()
+        await self.spawn()
+        await self.wait_ready()
+
+    async def watch(self):
+        while not self.stopping:
+            await self.running.wait()
+            process = self.process
+            await process.wait()
+            if self.stopping or process is not self.process or not self.running.is_set():
+                continue
+            logging.error("Воркер %s упал с кодом %s, перезапускаю", self.index, process.returncode)
+            await asyncio.sleep(1)
+            await self.spawn()
+
+    async def forward(self, session):
+        headers = {SECRET_HEADER: WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+        while True:
+            update = await self.queue.get()
+            delay = 0.1
+            while True:
+                await self.running.wait()
+                try:
+                    async with session.post(self.url, json=update, headers=headers) as response:
+                        if response.status == 200:
+                            break
+                        if response.status == 400:
+                            logging.error("Воркер %s отклонил апдейт %s", self.index, update.get("update_id"))
+                            break
+                except aiohttp.ClientError:
+                    pass
+                # Воркер ещё стартует или перезапускается: апдейт ждёт, порядок не нарушается
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2.0)
+            self.queue.task_done()
+
+
+class Supervisor:
+    # Одна точка приёма апдейтов (webhook или один поллер) и N процессов-воркеров.
+    # Пользователь закреплён за воркером по user_id, поэтому его FSM-кэш, профиль и порядок апдейтов
+    # живут в одном процессе; общие users/logs/FSM лежат в SQLite (WAL, один писатель за раз).
+    # Каждый воркер отправляет не больше 30 / N msg/s, чтобы вместе не превысить общий лимит Telegram на бота
+    def __init__(self, count, base_port):
+        self.workers = [Worker(index, count, base_port + index) for index in range(count)]
+        self.stop_event = asyncio.Event()
+        self.session = None
+
+    async def route(self, update):
+        worker = self.workers[shard_of(update_user_id(update), len(self.workers))]
+        await worker.queue.put(update)
+
+    async def handle(self, request):
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except Exception:
+            return web.Response(status=400)
+        await self.route(update)
+        return web.Response()
+
+    async def api(self, method, **params):
+        base = TELEGRAM_API_URL or "https://api.telegram.org"
+        async with self.session.post(f"{base}/bot{BOT_TOKEN}/{method}", json=params) as response:
+            data = await response.json()
+        if not data.get("ok"):
+            raise RuntimeError(f"{method}: {data.get('description')}")
+        return data["result"]
+
+    async def poll(self):
+        await self.api("deleteWebhook", drop_pending_updates=True)
+        offset = None
+        while not self.stop_event.is_set():
+            try:
+                updates = await self.api("getUpdates", offset=offset, timeout=25, allowed_updates=ALLOWED_UPDATES)
+            except Exception:
+                logging.exception("Ошибка getUpdates")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await self.route(update)
+                offset = update["update_id"] + 1
+
+    async def serve_webhook(self):
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        if WEBHOOK_URL:
+            await self.api(
+                "setWebhook", url=f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES, drop_pending_updates=True,
+            )
+        try:
+            await self.stop_event.wait()
+        finally:
+            await runner.cleanup()
+
+    async def rolling_restart(self):
+        # По одному воркеру: его апдейты копятся в очереди супервизора, пока новый процесс не начнёт слушать порт;
+        # остальные воркеры в это время работают
+        for worker in self.workers:
+            await worker.restart()
+        logging.info("Все воркеры перезапущены")
+
+    async def run(self):
+        # Схему обновляет супервизор до старта воркеров, чтобы они не применяли миграции наперегонки
+        conn = sqlite3.connect("bot_database.db")
+        apply_migrations(conn)
+        conn.close()
+
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop_event.set)
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.rolling_restart()))
+
+        async with aiohttp.ClientSession() as session:
+            self.session = session
+            for worker in self.workers:
+                await worker.spawn()
+            tasks = [asyncio.create_task(worker.watch()) for worker in self.workers]
+            tasks += [asyncio.create_task(worker.forward(session)) for worker in self.workers]
+            ingress = asyncio.create_task(self.serve_webhook() if WEBHOOK_ENABLED else self.poll())
+            await self.stop_event.wait()
+
+            # Плавная остановка: новые апдейты не принимаются, принятые доходят до воркеров,
+            # затем воркеры дорабатывают свои очереди и выходят
+            logging.info("Останавливаю приём апдейтов")
+            if WEBHOOK_ENABLED:
+                await ingress
+            else:
+                ingress.cancel()
+            await asyncio.gather(*(worker.queue.join() for worker in self.workers))
+            for worker in self.workers:
+                worker.stopping = True
+            await asyncio.gather(*(worker.terminate() for worker in self.workers))
+            for task in tasks:
+                task.cancel()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    asyncio.run(Supervisor(WORKERS, WORKER_BASE_PORT).run())
@@ -0,0 +1,80 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.fsm.storage.base import BaseEventIsolation
+
+
+class UserEventIsolation(BaseEventIsolation):
+    # Замок на ключ FSM: FSMContextMiddleware читает состояние уже под ним, поэтому апдейты одного пользователя
+    # идут строго по очереди (asyncio.Lock отдаёт захват в порядке ожидания) и видят результат предыдущего.
+    # Слот общего семафора берётся после замка: ожидающие своей очереди апдейты слоты не занимают
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+        self.locks = {}
+        self.active = 0
+
+    @asynccontextmanager
+    async def lock(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self.semaphore:
+                    self.active += 1
+                    try:
+                        yield
+                    finally:
+                        self.active -= 1
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[key]
+
+    async def close(self):
+        self.locks.clear()
+
+
+class UserSerialMiddleware(BaseMiddleware):
+    # Разные пользователи обрабатываются параллельно, но не больше max_concurrency одновременно.
+    # Регистрируется раньше FSMContextMiddleware: повторное нажатие снимается до очереди на замок пользователя
+    def __init__(self, max_concurrency=64):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.isolation = UserEventIsolation(self.semaphore)
+        self.pending = set()
+        self.dropped = 0
+        self.unlocked = 0
+
+    @property
+    def active(self):
+        return self.isolation.active + self.unlocked
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            # Без пользователя нет FSM-контекста и замка, ограничиваем только общим семафором
+            async with self.semaphore:
+                self.unlocked += 1
+                try:
+                    return await handler(event, data)
+                finally:
+                    self.unlocked -= 1
+
+        callback = event.callback_query
+        key = (user.id, callback.data) if callback is not None else None
+        if key is None:
+            return await handler(event, data)
+        if key in self.pending:
+            # Такое же нажатие уже ждёт или обрабатывается: повтор только снимаем с «часиков»
+            self.dropped += 1
+            with suppress(TelegramBadRequest):
+                await callback.answer()
+            return None
+        self.pending.add(key)
+        try:
+            return await handler(event, data)
+        finally:
+            self.pending.discard(key)
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+
+from aiohttp import web
+from aiogram import types
+
+
+class WebhookServer:
+    # Принимает апдейты от Telegram и отдаёт их в тот же dp через ограниченный пул воркеров.
+    # Ответ Telegram отправляется сразу после постановки в очередь; если очередь полна, запрос ждёт (backpressure).
+    def __init__(self, dp, bot, path, secret=None, workers=32, queue_size=1000):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.worker_tasks = []
+        self.runner = None
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request):
+        if self.secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=401)
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception:
+            return web.Response(status=400)
+        await self.queue.put(update)
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception:
+                logging.exception("Ошибка обработки апдейта %s", update.update_id)
+            finally:
+                self.queue.task_done()
+
+    async def start(self, host, port):
+        self.worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.runner = web.AppRunner(self.make_app())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logging.info("Webhook слушает %s:%s%s", host, port, self.path)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+        await self.queue.join()
+        for task in self.worker_tasks:
+            task.cancel()
+        self.worker_tasks = []